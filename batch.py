@@ -0,0 +1,187 @@
+"""Headless batch generation driven by a JSONL file of jobs.
+
+Each input line is a JSON object with a "prompt" (or an "idea" to expand
+with generate_prompt first) and optional "id", "size", "steps", "guidance",
+"num_images", "seed", "safety_tolerance" and "upscale" fields. One result
+line is appended to the output file per job as soon as it finishes.
+
+Usage: python batch.py jobs.jsonl -o results.jsonl --concurrency 4 --rate 2
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from core import generate_image, generate_prompt, save_images
+from metrics import start_metrics_server
+from ratelimit import TokenBucket
+
+# Set up logging
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB = {
+    "size": "square_hd",
+    "steps": 28,
+    "guidance": 3.5,
+    "num_images": 1,
+    "seed": 0,
+    "safety_tolerance": "6",
+    "upscale": False
+}
+
+class Checkpoint:
+    """Tracks finished input lines so a crashed run can resume.
+
+    Only the first unfinished line number plus the finished lines after it
+    are stored, so the checkpoint stays small however long the input is.
+    Results are written before the checkpoint, so a crash in between can
+    repeat at most the jobs that were in flight.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.next_line = 0
+        self.done = set()
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                state = json.load(f)
+            self.next_line = state["next_line"]
+            self.done = set(state["done"])
+
+    def is_done(self, line_no):
+        return line_no < self.next_line or line_no in self.done
+
+    def mark(self, line_no):
+        self.done.add(line_no)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"next_line": self.next_line, "done": sorted(self.done)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+def read_jobs(path):
+    # Streams (line number, job or error message) without loading the whole file
+    with open(path, "r") as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                yield line_no, None
+                continue
+            try:
+                job = json.loads(line)
+                if not isinstance(job, dict):
+                    raise ValueError("job must be a JSON object")
+            except ValueError as e:
+                yield line_no, f"Invalid job: {str(e)}"
+                continue
+            yield line_no, job
+
+def run_job(line_no, job):
+    result = {"line": line_no, "id": job.get("id", line_no)}
+    params = {**DEFAULT_JOB, **job}
+
+    prompt = params.get("prompt")
+    if not prompt and params.get("idea"):
+        prompt = generate_prompt(params["idea"])
+        if "Failed to generate prompt" in prompt:
+            return {**result, "status": "error", "error": prompt}
+    if not prompt:
+        return {**result, "status": "error", "error": "Job has no prompt or idea"}
+
+    images, image_urls, error = generate_image(
+        prompt,
+        params["size"],
+        params["steps"],
+        params["guidance"],
+        params["num_images"],
+        params["seed"],
+        params["safety_tolerance"],
+        False,
+        params["upscale"]
+    )
+    if not images:
+        return {**result, "status": "error", "prompt": prompt, "error": error or "No image was generated"}
+
+    paths = save_images(images, prompt)
+    result.update({"status": "ok", "prompt": prompt, "paths": paths, "image_urls": image_urls})
+    if error:
+        result["error"] = error
+    return result
+
+def run_job_safely(line_no, job):
+    try:
+        return run_job(line_no, job)
+    except Exception as e:
+        logger.exception(f"Job on line {line_no} failed")
+        return {"line": line_no, "id": job.get("id", line_no), "status": "error", "error": str(e)}
+
+def run_batch(input_path, output_path, checkpoint_path=None, concurrency=4, rate=None):
+    checkpoint = Checkpoint(checkpoint_path)
+    # A burst of 1 spaces job starts at least 1/rate seconds apart
+    limiter = TokenBucket(rate, burst=1, name="batch")
+    counts = {"ok": 0, "error": 0}
+
+    def record(result, out):
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        counts[result["status"]] += 1
+        checkpoint.mark(result["line"])
+        checkpoint.save()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, open(output_path, "a") as out:
+        in_flight = set()
+
+        def drain(return_when):
+            nonlocal in_flight
+            done, in_flight = wait(in_flight, return_when=return_when)
+            for future in done:
+                record(future.result(), out)
+
+        for line_no, job in read_jobs(input_path):
+            if checkpoint.is_done(line_no):
+                continue
+            if job is None:
+                checkpoint.mark(line_no)
+                continue
+            if isinstance(job, str):
+                record({"line": line_no, "id": line_no, "status": "error", "error": job}, out)
+                continue
+
+            # Only `concurrency` jobs are held in memory at any time
+            if len(in_flight) >= concurrency:
+                drain(FIRST_COMPLETED)
+            limiter.acquire()
+            in_flight.add(executor.submit(run_job_safely, line_no, job))
+
+        if in_flight:
+            drain(ALL_COMPLETED)
+        checkpoint.save()
+
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate images for every job in a JSONL file.")
+    parser.add_argument("input", help="JSONL file with one job per line")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--checkpoint", help="checkpoint file used to resume (default: <output>.checkpoint)")
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs run at the same time")
+    parser.add_argument("--rate", type=float, default=None, help="maximum jobs started per second")
+    args = parser.parse_args()
+    start_metrics_server()
+
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    counts = run_batch(args.input, args.output, checkpoint_path, args.concurrency, args.rate)
+    print(f"Finished: {counts['ok']} succeeded, {counts['error']} failed")
+
+if __name__ == "__main__":
+    main()
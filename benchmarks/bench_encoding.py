@@ -0,0 +1,65 @@
+"""Bytes per image and encode time per image for each output encoding.
+
+The test image is a synthetic render (smooth gradients, hard edges and fine
+grain) at the size the API returns and at 2x, the size of an upscaled image.
+Data URL bytes are what a download link adds to the page.
+
+Run with: python benchmarks/bench_encoding.py [--size 1024] [--images 4]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import encoding
+from image_record import ImageRecord
+
+ENCODINGS = ("png:1", "png:6", "png:9", "webp:lossless", "webp:85", "jpeg:90", "avif:60")
+
+def make_image(size, seed=0):
+    # Something between a photo and flat artwork, like most generated images
+    gradient = Image.linear_gradient("L").resize((size, size))
+    image = Image.merge("RGB", (gradient, gradient.rotate(90), Image.effect_mandelbrot((size, size), (-2, -1.5, 1, 1.5), 64)))
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        x, y = (seed * 97 + i * 151) % size, (seed * 53 + i * 89) % size
+        draw.ellipse((x, y, x + size // 6, y + size // 8), fill=(40 * i % 255, 90, 200 - 10 * i))
+    grain = Image.effect_noise((size, size), 12).convert("RGB")
+    return Image.blend(image.filter(ImageFilter.GaussianBlur(1)), grain, 0.08)
+
+def measure(records, spec):
+    start = time.perf_counter()
+    encoded = [encoding.encode(record, "benchmark", spec) for record in records]
+    serial = (time.perf_counter() - start) / len(records)
+    start = time.perf_counter()
+    encoding.encode_all(records, "benchmark", spec)
+    pooled = (time.perf_counter() - start) / len(records)
+    size = sum(len(record.data) for record in encoded) / len(records)
+    data_url = sum(len(record.data_url()) for record in encoded) / len(records)
+    return encoded[0].format, size, data_url, serial, pooled
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare output encodings by size and speed.")
+    parser.add_argument("--size", type=int, default=1024, help="width and height of generated images")
+    parser.add_argument("--images", type=int, default=4, help="images encoded per measurement")
+    parser.add_argument("--encodings", nargs="+", default=ENCODINGS)
+    args = parser.parse_args()
+
+    print(f"{encoding.ENCODE_WORKERS} encode workers")
+    for size in (args.size, args.size * 2):
+        # Decoded up front, the benchmark measures encoding only
+        records = [ImageRecord.from_image(make_image(size, seed)) for seed in range(args.images)]
+        print(f"{size}x{size}:")
+        print(f"  {'encoding':14s} {'KB/image':>9s} {'data URL KB':>12s} {'ms/image':>9s} {'pooled ms':>10s}")
+        for spec in args.encodings:
+            format, size_bytes, data_url_bytes, serial, pooled = measure(records, spec)
+            note = "" if format == encoding.parse_encoding(spec)[0] else f"  (fell back to {format})"
+            print(f"  {spec:14s} {size_bytes / 1024:9.0f} {data_url_bytes / 1024:12.0f} "
+                  f"{serial * 1000:9.1f} {pooled * 1000:10.1f}{note}")
+
+if __name__ == "__main__":
+    main()
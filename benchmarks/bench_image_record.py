@@ -0,0 +1,80 @@
+"""CPU time and peak allocations per image: PIL round-trips vs ImageRecord.
+
+The "decode + re-encode" path mirrors the old flow, where the downloaded
+bytes were decoded and then PNG-encoded again for the upscale payload, the
+archive copy, the history copy and the download link. The "ImageRecord"
+path reuses the original bytes for all four.
+
+Peak allocations come from tracemalloc, which only sees Python-level
+allocations; Pillow's decoded pixel buffers are extra on the old path.
+
+Run with: python benchmarks/bench_image_record.py
+"""
+import base64
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from image_record import ImageRecord
+from stub_server import make_test_image
+
+CASES = [
+    ("square_hd (1024x1024 JPEG from CDN)", (1024, 1024), "JPEG"),
+    ("upscaled 2x (2048x2048 PNG from upscaler)", (2048, 2048), "PNG"),
+]
+
+def make_source(size, format):
+    buffered = BytesIO()
+    make_test_image(size).save(buffered, format=format)
+    return buffered.getvalue()
+
+def encode_png(image):
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def old_flow(data, directory):
+    image = Image.open(BytesIO(data))
+    image.load()
+    base64.b64encode(encode_png(image))  # Upscale payload
+    image.save(os.path.join(directory, "archive.png"))  # save_images
+    with open(os.path.join(directory, "history.png"), "wb") as f:  # History
+        f.write(encode_png(image))
+    base64.b64encode(encode_png(image))  # Download link
+
+def new_flow(data, directory):
+    record = ImageRecord(data)
+    record.data_url()  # Upscale payload
+    with open(os.path.join(directory, f"archive.{record.extension}"), "wb") as f:
+        f.write(record.data)
+    with open(os.path.join(directory, f"history.{record.extension}"), "wb") as f:
+        f.write(record.data)
+    record.data_url()  # Download link
+
+def measure(flow, data, directory):
+    tracemalloc.start()
+    start = time.process_time()
+    flow(data, directory)
+    cpu = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        for label, size, format in CASES:
+            data = make_source(size, format)
+            print(f"{label}, {len(data) / 1e6:.1f} MB encoded")
+            for name, flow in (("decode + re-encode", old_flow), ("ImageRecord", new_flow)):
+                cpu, peak = measure(flow, data, directory)
+                print(f"  {name:20s} cpu {cpu * 1000:8.1f} ms   peak alloc {peak / 1e6:7.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Local CPU upscaling vs the remote GFPGAN path.
+
+The remote path runs against the stub server with no added delay, so it
+only measures what this process spends on it: base64 upload, transfer of
+the upscaled result and decoding. Real spaces add queueing and GPU time
+on top. The tiled run only beats the single-process one on machines with
+more than one core.
+
+Each mode runs in a fresh interpreter, so its peak RSS (read from the OS,
+including Pillow's pixel buffers) is its own. The stub serves from a
+separate process and is not counted; the tiled mode also reports the
+summed peak RSS of its worker processes (Linux only).
+
+Run with: python benchmarks/bench_local_upscaler.py
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upscalers
+from image_record import ImageRecord
+from stub_server import StubServer, make_test_image
+
+SIZES = [(1024, 1024), (2048, 2048)]
+MODES = [("local, single process", "single"), ("local, tiled", "tiled"), ("remote (stub, no delay)", "remote")]
+RUNS = 3
+
+def make_record(size):
+    return ImageRecord.from_image(make_test_image(size), "JPEG", quality=90)
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def workers_peak_rss_mb(backend):
+    # Summed high-water marks of the tile workers, read before the pool shuts down
+    pool = getattr(backend, "_pool", None)
+    total_kb = 0
+    for pid in (pool._processes if pool is not None else ()):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                total_kb += next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+        except (OSError, StopIteration):
+            return None
+    return total_kb / 1024
+
+def serve_upscaled(size, ready):
+    # The stub answers with an image of the upscaled size, like GFPGAN would
+    record = make_record(size)
+    upscaled_bytes = ImageRecord.from_image(record.image.resize((size[0] * 2, size[1] * 2)), "PNG").data
+    with StubServer(image_bytes=upscaled_bytes) as server:
+        ready.put(server.url)
+        threading.Event().wait()
+
+def run_mode(mode, size):
+    record = make_record(size)
+    stub = None
+    if mode == "remote":
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        stub = context.Process(target=serve_upscaled, args=(size, ready), daemon=True)
+        stub.start()
+        backend = upscalers.RemoteUpscaler("stub", f"{ready.get()}/api/predict")
+    elif mode == "tiled":
+        # At least two workers, otherwise LocalUpscaler never tiles
+        backend = upscalers.LocalUpscaler(tile_threshold=0, processes=max(2, upscalers.LOCAL_PROCESSES))
+    else:
+        backend = upscalers.LocalUpscaler(processes=1)
+    try:
+        backend.upscale(record, "v1.4", 2)  # Warm up pools and connections
+        start = time.perf_counter()
+        for _ in range(RUNS):
+            result = backend.upscale(ImageRecord(record.data), "v1.4", 2)
+        elapsed = (time.perf_counter() - start) / RUNS
+        return {"elapsed": elapsed, "output_mb": len(result.data) / 1e6,
+                "rss_mb": peak_rss_mb(), "workers_mb": workers_peak_rss_mb(backend)}
+    finally:
+        if stub is not None:
+            stub.terminate()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare local and remote upscaling.")
+    parser.add_argument("--mode", choices=[mode for _, mode in MODES], help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, (args.size, args.size))))
+        return
+
+    for size in SIZES:
+        print(f"{size[0]}x{size[1]} -> {size[0] * 2}x{size[1] * 2}")
+        megapixels = size[0] * size[1] / 1e6
+        for label, mode in MODES:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--mode", mode, "--size", str(size[0])],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output.splitlines()[-1])
+            workers = f" + workers {result['workers_mb']:.0f} MB" if result["workers_mb"] else ""
+            print(f"  {label:24s} {result['elapsed']:6.2f}s/image  {megapixels / result['elapsed']:6.2f} MP/s  "
+                  f"output {result['output_mb']:5.1f} MB  peak RSS {result['rss_mb']:5.0f} MB{workers}")
+
+if __name__ == "__main__":
+    main()
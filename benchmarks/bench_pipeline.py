@@ -0,0 +1,49 @@
+"""Compare sequential vs concurrent download/upscale in generate_image.
+
+Run with: python benchmarks/bench_pipeline.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core
+import ratelimit
+import upscalers
+from stub_server import StubServer
+
+NUM_IMAGES = 4
+DOWNLOAD_DELAY = 0.3
+UPSCALE_DELAY = 0.5
+
+def run(max_workers, upscale):
+    start = time.perf_counter()
+    images, _, error = core.generate_image(
+        "benchmark", "square_hd", 28, 3.5, NUM_IMAGES, 0, "6", True,
+        upscale=upscale, max_workers=max_workers
+    )
+    elapsed = time.perf_counter() - start
+    assert images and len(images) == NUM_IMAGES and error is None
+    return elapsed
+
+def main():
+    # Downloads are streamed into ./generated_images, keep them out of the repo
+    os.chdir(tempfile.mkdtemp())
+    with StubServer(download_delay=DOWNLOAD_DELAY, upscale_delay=UPSCALE_DELAY) as server:
+        core.IMAGE_GEN_URL = f"{server.url}/images/generations"
+        upscalers.upscale_router = upscalers.build_router([f"{server.url}/api/predict"])
+        core.GENERATION_CACHE_ENABLED = False
+        # Measure the pipeline, not waits for the process-wide rate limits
+        for limiter in ratelimit.limiters.values():
+            limiter.rate = 0
+
+        for upscale in (False, True):
+            per_image = DOWNLOAD_DELAY + (UPSCALE_DELAY if upscale else 0)
+            print(f"upscale={upscale}: {NUM_IMAGES} images, {per_image:.1f}s stub latency per image")
+            for max_workers in (1, NUM_IMAGES):
+                print(f"  max_workers={max_workers}: {run(max_workers, upscale):.2f}s")
+
+if __name__ == "__main__":
+    main()
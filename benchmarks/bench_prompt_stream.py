@@ -0,0 +1,107 @@
+"""Compare time to first visible text for blocking vs streamed prompt generation.
+
+Before timing, the streaming client is checked against malformed, cut-off
+and concurrent identical streams from the stub.
+
+Run with: python benchmarks/bench_prompt_stream.py
+"""
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core
+import ratelimit
+from stub_server import StubServer
+
+CHAT_DELAY = 0.3
+TOKEN_DELAY = 0.03
+RUNS = 5
+
+def blocking():
+    start = time.perf_counter()
+    text = core.generate_prompt("a lighthouse in a storm", fresh=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed, text
+
+def streamed():
+    start = time.perf_counter()
+    first_token = None
+    parts = []
+    for part in core.stream_prompt("a lighthouse in a storm", fresh=True):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        parts.append(part)
+    return first_token, time.perf_counter() - start, "".join(parts)
+
+def delta(text):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': text}}]})}\n\n".encode()
+
+FAILED = f"\n\n{core.PROMPT_FAILED_MESSAGE}"
+# (chunks sent by the stub, expected text); a None chunk drops the connection
+STREAM_CASES = {
+    "multi-line data": ([b'data: {"choices":\ndata: [{"delta": {"content": "a"}}]}\n\n', delta(" b"), b"data: [DONE]\n\n"], "a b"),
+    "comment lines": ([b": keep-alive\n\n", delta("a"), b": ping\n", delta(" b"), b"data: [DONE]\n\n"], "a b"),
+    "line split across chunks": ([delta("a")[:10], delta("a")[10:], b"data: [DONE]\n\n"], "a"),
+    "no trailing blank line": ([delta("a"), b"data: [DONE]"], "a"),
+    "ended before [DONE]": ([delta("a")], "a" + FAILED),
+    "connection dropped": ([delta("a"), None], "a" + FAILED),
+}
+
+def consume_concurrently(user_input, callers):
+    texts = []
+    threads = [threading.Thread(target=lambda: texts.append("".join(core.stream_prompt(user_input))))
+               for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return texts
+
+def check_streams(server):
+    for name, (chunks, expected) in STREAM_CASES.items():
+        server.chat_stream_chunks = chunks
+        text = "".join(core.stream_prompt(name, fresh=True))
+        assert text == expected, (name, text)
+        cached = core.prompt_cache.get(core.cache_key(core.CHAT_MODEL, core.SYSTEM_PROMPT_HASH, name, 1))
+        assert cached == (None if expected.endswith(FAILED) else expected), (name, cached)
+    server.chat_stream_chunks = None
+    print(f"  {len(STREAM_CASES)} malformed and cut-off streams handled")
+
+    before = server.chat_requests
+    texts = consume_concurrently("shared stream", 4)
+    assert server.chat_requests - before == 1 and len(set(texts)) == 1, (server.chat_requests - before, texts)
+    print("  4 identical concurrent streams made 1 request")
+
+    # A leader abandoned midway ends its joiners' streams with the failure message
+    leader = core.stream_prompt("abandoned stream")
+    first = next(leader)
+    joiner = threading.Thread(target=lambda: texts.append("".join(core.stream_prompt("abandoned stream"))))
+    joiner.start()
+    time.sleep(TOKEN_DELAY * 3)
+    leader.close()
+    joiner.join()
+    assert texts[-1].startswith(first) and texts[-1].endswith(FAILED), texts[-1]
+    print("  joiners of an abandoned stream get the failure message")
+
+def main():
+    with StubServer(chat_delay=CHAT_DELAY, chat_token_delay=TOKEN_DELAY) as server:
+        core.CHAT_URL = f"{server.url}/chat/completions"
+        ratelimit.limiters["chat"].rate = 0  # Time the stream, not the chat rate limit
+        check_streams(server)
+        print(f"Stub: {CHAT_DELAY * 1000:.0f}ms before the first token, {TOKEN_DELAY * 1000:.0f}ms per token")
+        texts = set()
+        for name, fn in (("blocking", blocking), ("streamed", streamed)):
+            runs = [fn() for _ in range(RUNS)]
+            texts.update(text for _, _, text in runs)
+            first = statistics.median(first for first, _, _ in runs)
+            total = statistics.median(total for _, total, _ in runs)
+            print(f"  {name}: first text after {first * 1000:.0f}ms, complete after {total * 1000:.0f}ms")
+        assert len(texts) == 1, texts
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Cold start: import time of the core modules and time to first render of the app.
+
+Each measurement runs in a fresh interpreter, like a newly started container.
+Import times come from `python -X importtime`; first render is the time until
+Streamlit's AppTest has run imagen.py once.
+
+Run with: python benchmarks/bench_startup.py [--runs 5] [--top 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("core", "batch", "storage")
+
+FIRST_RENDER_SCRIPT = """
+import time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+app = AppTest.from_file({path!r}, default_timeout=120).run()
+assert not app.exception, app.exception
+print(imported - start, time.perf_counter() - start)
+"""
+
+def run_python(args, cwd):
+    env = {**os.environ, "PYTHONPATH": ROOT, "METRICS_PORT": "0"}
+    result = subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    return result
+
+def import_times(module, cwd):
+    # Returns the module's cumulative import time in us and {name: cumulative us}
+    # for everything it imported. Children are printed before their parent, so
+    # the module's imports are the lines since the previous top-level import
+    stderr = run_python(["-X", "importtime", "-c", f"import {module}"], cwd).stderr
+    children = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            if name.strip() == module:
+                return int(cumulative_us), children
+            children = {}
+            continue
+        children[name.strip()] = int(cumulative_us)
+    raise RuntimeError(f"{module} not found in -X importtime output")
+
+def first_render(cwd):
+    script = FIRST_RENDER_SCRIPT.format(path=os.path.join(ROOT, "imagen.py"))
+    imported, rendered = run_python(["-c", script], cwd).stdout.split()
+    return float(imported), float(rendered)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold import and first render times.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=10, help="heaviest imports to list per module")
+    args = parser.parse_args()
+
+    # The app creates its database and folders in the working directory
+    cwd = tempfile.mkdtemp()
+
+    for module in MODULES:
+        runs = [import_times(module, cwd) for _ in range(args.runs)]
+        total = statistics.median(total_us for total_us, _ in runs) / 1000
+        print(f"import {module}: {total:.1f}ms (median of {args.runs})")
+        heaviest = sorted(runs[-1][1].items(), key=lambda item: item[1], reverse=True)
+        for name, cumulative_us in heaviest[:args.top]:
+            print(f"  {cumulative_us / 1000:7.1f}ms  {name}")
+
+    renders = [first_render(cwd) for _ in range(args.runs)]
+    print(f"streamlit import: {statistics.median(imported for imported, _ in renders) * 1000:.0f}ms, "
+          f"first render of imagen.py: {statistics.median(rendered for _, rendered in renders) * 1000:.0f}ms "
+          f"(median of {args.runs})")
+
+if __name__ == "__main__":
+    main()
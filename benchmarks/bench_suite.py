@@ -0,0 +1,168 @@
+"""Throughput, latency and memory of the main code paths against the stub APIs.
+
+Scenarios: single image, multi image, upscaled image, and history
+save (direct and through the background writer) and load at 10, 100 and
+1000 entries. Results can be written to JSON and
+compared with an earlier run to spot regressions.
+
+Run with: python benchmarks/bench_suite.py [--json results.json] [--baseline old.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core
+import ratelimit
+import storage
+import upscalers
+from image_record import ImageRecord
+from stub_server import StubServer, make_png
+
+HISTORY_SIZES = (10, 100, 1000)
+# Slower than the baseline by more than this fraction counts as a regression
+REGRESSION_THRESHOLD = 0.2
+
+def measure(fn, repeat, setup=None):
+    # Timed runs first, then one run under tracemalloc for the memory peak
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings.sort()
+    return {
+        "mean": statistics.mean(timings),
+        "p50": timings[len(timings) // 2],
+        "p95": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        "peak_mb": peak / 1024 / 1024
+    }
+
+def generation_scenario(num_images, upscale):
+    def run():
+        images, _, error = core.generate_image(
+            "benchmark", "square_hd", 28, 3.5, num_images, 0, "6", False, upscale=upscale
+        )
+        if not images:
+            raise RuntimeError(error)
+        for image in images:
+            if image.path:
+                os.remove(image.path)
+    return run
+
+def history_save_scenario(records, count):
+    def run():
+        for i in range(count):
+            storage.add_history_item(records[i], f"benchmark {i}", f"2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}")
+    return run
+
+def history_writer_scenario(records, count):
+    # Same items through the background writer, including the final flush
+    def run():
+        for i in range(count):
+            storage.history_writer.add(records[i], f"benchmark {i}", f"2024-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}")
+        storage.history_writer.flush()
+    return run
+
+def history_load_scenario():
+    # Pages through the whole history and renders the first page of thumbnails
+    def run():
+        page = storage.load_history()
+        for item in page:
+            storage.get_thumbnail(item)
+        while page:
+            page = storage.load_history(before=page[-1])
+    return run
+
+def reset_history():
+    for path in (storage.HISTORY_DB, f"{storage.HISTORY_DB}-wal", f"{storage.HISTORY_DB}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    for directory in (storage.HISTORY_IMAGES_DIR, storage.THUMBNAIL_DIR):
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+
+def print_results(results, baseline):
+    print(f"{'scenario':<22}{'mean':>10}{'p50':>10}{'p95':>10}{'peak MB':>10}")
+    for name, result in results.items():
+        line = (f"{name:<22}{result['mean'] * 1000:>8.1f}ms{result['p50'] * 1000:>8.1f}ms"
+                f"{result['p95'] * 1000:>8.1f}ms{result['peak_mb']:>10.1f}")
+        previous = baseline.get(name)
+        if previous:
+            change = result["mean"] / previous["mean"] - 1
+            line += f"  {change:+.0%} vs baseline"
+            if change > REGRESSION_THRESHOLD:
+                line += "  REGRESSION"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark generation, upscaling and history against stub APIs.")
+    parser.add_argument("--repeat", type=int, default=10, help="timed runs per generation scenario")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra stub latency in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of stub requests that fail")
+    parser.add_argument("--image-size", type=int, default=1024, help="width and height of generated images")
+    parser.add_argument("--history-sizes", type=int, nargs="+", default=HISTORY_SIZES)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare with results written by an earlier --json run")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    # Downloads, history and thumbnails are written to the working directory
+    json_path = os.path.abspath(args.json) if args.json else None
+    os.chdir(tempfile.mkdtemp())
+    core.GENERATION_CACHE_ENABLED = False
+    # Measure the pipeline, not waits for the process-wide rate limits
+    for limiter in ratelimit.limiters.values():
+        limiter.rate = 0
+    results = {}
+    stub_options = {f"{route}_{name}": value
+                    for route in ("generation", "download", "upscale")
+                    for name, value in (("delay", args.latency), ("fail_rate", args.fail_rate))}
+    image_bytes = make_png(args.image_size, args.image_size, noise=True)
+    with StubServer(image_bytes=image_bytes, jitter=args.jitter, **stub_options) as server:
+        core.IMAGE_GEN_URL = f"{server.url}/images/generations"
+        upscalers.upscale_router = upscalers.build_router([f"{server.url}/api/predict"], "remote")
+        print(f"Stub latency {args.latency * 1000:.0f}ms, {len(image_bytes) / 1024:.0f} KB images, "
+              f"fail rate {args.fail_rate:.0%}")
+
+        results["single"] = measure(generation_scenario(1, False), args.repeat)
+        results["multi_4"] = measure(generation_scenario(4, False), args.repeat)
+        results["upscale"] = measure(generation_scenario(1, True), args.repeat)
+        if server.failures["generation"] or server.failures["download"] or server.failures["upscale"]:
+            print(f"Injected failures: {server.failures}")
+
+    # Distinct images, so every entry gets its own stored file and thumbnail
+    records = [ImageRecord(make_png(128, 128, color=(i % 256, i // 256, 200))) for i in range(max(args.history_sizes))]
+    for count in args.history_sizes:
+        save = history_save_scenario(records, count)
+        results[f"history_save_{count}"] = measure(save, 1, setup=reset_history)
+        results[f"history_writer_{count}"] = measure(history_writer_scenario(records, count), 1, setup=reset_history)
+        results[f"history_load_{count}"] = measure(history_load_scenario(), 3)
+
+    print_results(results, baseline)
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
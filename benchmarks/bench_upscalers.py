@@ -0,0 +1,58 @@
+"""Upscaler routing against stub endpoints with injected delay and failures.
+
+Three stub upscalers are started: a fast one, a slow one and a broken one.
+The script shows the router settling on the fast endpoint, the circuit
+breaker opening for the broken one, and hedged requests cutting the tail
+when the preferred endpoint suddenly slows down.
+
+Run with: python benchmarks/bench_upscalers.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upscalers
+from image_record import ImageRecord
+from stub_server import StubServer, make_png
+
+REQUESTS = 20
+
+def run(router, record, label):
+    latencies = []
+    for _ in range(REQUESTS):
+        start = time.perf_counter()
+        result = router.upscale(record)
+        latencies.append(time.perf_counter() - start)
+        assert result is not None
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{label}: p50 {p50:.2f}s  p95 {p95:.2f}s  max {latencies[-1]:.2f}s")
+
+def main():
+    record = ImageRecord(make_png())
+    with StubServer(upscale_delay=0.1) as fast, \
+            StubServer(upscale_delay=0.6) as slow, \
+            StubServer(upscale_fail_rate=1.0) as broken:
+        backends = [
+            upscalers.RemoteUpscaler("broken", f"{broken.url}/api/predict", max_retries=0),
+            upscalers.RemoteUpscaler("slow", f"{slow.url}/api/predict", max_retries=0),
+            upscalers.RemoteUpscaler("fast", f"{fast.url}/api/predict", max_retries=0),
+        ]
+        router = upscalers.UpscaleRouter(backends, hedge_delay=0.3)
+
+        run(router, record, "steady state")
+        for name, stats in router.stats.items():
+            print(f"  {name:6s} {stats.snapshot()}")
+        print(f"  requests: fast={fast.upscale_requests} slow={slow.upscale_requests} broken={broken.upscale_requests}")
+
+        # The preferred endpoint degrades; hedging moves work to the other one
+        fast.upscale_delay = 2.0
+        run(router, record, "fast endpoint degraded, hedging on")
+        for name, stats in router.stats.items():
+            print(f"  {name:6s} {stats.snapshot()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Local stand-in for the AIML API, its image CDN and the GFPGAN upscalers.
+
+Every route can be given a latency (plus random jitter) and a failure rate,
+and the size of the served images is configurable, so benchmarks exercise
+the real client code without network access or an API key.
+
+Run standalone and point the app at it with:
+
+    python benchmarks/stub_server.py --port 8000
+    AIML_API_BASE_URL=http://127.0.0.1:8000 \\
+    UPSCALE_API_URLS=http://127.0.0.1:8000/api/predict streamlit run imagen.py
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+from PIL import Image
+
+def make_png(width=64, height=64, color=(52, 152, 219), noise=False):
+    # Noise makes the PNG incompressible, so its size grows with the pixel count
+    if noise:
+        image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    else:
+        image = Image.new("RGB", (width, height), color)
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+def make_test_image(size):
+    # Smooth gradients with grain, compresses roughly like a generated image
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 32)
+    return Image.merge("RGB", [gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 for chunked server-sent events; every other response sets Content-Length
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            self.close_connection = True  # The client gave up waiting, e.g. on a read timeout
+
+    def _send_json(self, data, status=200):
+        self._send(status, json.dumps(data).encode())
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_chunks(self, chunks):
+        # Sends each chunk separately, chat_token_delay apart; a None chunk
+        # drops the connection mid-stream
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, chunk in enumerate(chunks):
+            if chunk is None:
+                self.close_connection = True
+                return
+            if i:
+                time.sleep(self.server.chat_token_delay)
+            try:
+                self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.flush()
+            except ConnectionError:
+                # The client stopped reading, e.g. an abandoned stream
+                self.close_connection = True
+                return
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _simulate(self, route):
+        # Sleeps for the route's latency; returns False when a failure was injected
+        server = self.server
+        server.requests[route] += 1
+        time.sleep(getattr(server, f"{route}_delay") + random.uniform(0, server.jitter))
+        if random.random() < getattr(server, f"{route}_fail_rate"):
+            server.failures[route] += 1
+            self._send_json({"error": f"{route} unavailable"}, 503)
+            return False
+        return True
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith("/cdn/"):
+            if self._simulate("download"):
+                self._send(200, server.image_bytes, "image/png")
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        server = self.server
+        payload = self._read_json()
+        if self.path == "/images/generations":
+            if self._simulate("generation"):
+                images = [{"url": f"{server.url}/cdn/{i}.png"} for i in range(payload.get("num_images", 1))]
+                self._send_json({"images": images})
+        elif self.path == "/chat/completions":
+            if self._simulate("chat"):
+                content = f"Expanded prompt for: {payload['messages'][-1]['content']}"
+                tokens = [f" {word}" if i else word for i, word in enumerate(content.split(" "))]
+                if payload.get("stream") and server.chat_stream_chunks is not None:
+                    self._send_chunks(server.chat_stream_chunks)
+                elif payload.get("stream"):
+                    events = [json.dumps({"choices": [{"delta": {"content": token}}]}) for token in tokens]
+                    self._send_chunks([f"data: {event}\n\n".encode() for event in events + ["[DONE]"]])
+                else:
+                    # Without streaming the whole completion is generated before anything is sent
+                    time.sleep(server.chat_token_delay * (len(tokens) - 1))
+                    self._send_json({"choices": [{"message": {"role": "assistant", "content": content}}]})
+        elif self.path == "/api/predict":
+            if self._simulate("upscale"):
+                img_str = base64.b64encode(server.image_bytes).decode()
+                self._send_json({"data": [f"data:image/png;base64,{img_str}"]})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+ROUTES = ("generation", "download", "chat", "upscale")
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, generation_delay=0.0, download_delay=0.0, upscale_delay=0.0, chat_delay=0.0,
+                 upscale_fail_rate=0.0, image_bytes=None, generation_fail_rate=0.0, download_fail_rate=0.0,
+                 chat_fail_rate=0.0, jitter=0.0, port=0, chat_token_delay=0.0):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.generation_delay = generation_delay
+        self.download_delay = download_delay
+        self.upscale_delay = upscale_delay
+        self.chat_delay = chat_delay
+        self.generation_fail_rate = generation_fail_rate
+        self.download_fail_rate = download_fail_rate
+        self.upscale_fail_rate = upscale_fail_rate
+        self.chat_fail_rate = chat_fail_rate
+        self.chat_token_delay = chat_token_delay
+        # Raw bytes to stream instead of the generated events, for malformed or cut-off streams
+        self.chat_stream_chunks = None
+        self.jitter = jitter
+        self.requests = dict.fromkeys(ROUTES, 0)
+        self.failures = dict.fromkeys(ROUTES, 0)
+        self.image_bytes = image_bytes or make_png()
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def chat_requests(self):
+        return self.requests["chat"]
+
+    @property
+    def upscale_requests(self):
+        return self.requests["upscale"]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stub of the image APIs.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--image-size", type=int, default=1024, help="width and height of served images")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra latency in seconds")
+    parser.add_argument("--chat-token-delay", type=float, default=0.0, help="seconds between streamed prompt tokens")
+    for route in ROUTES:
+        parser.add_argument(f"--{route}-delay", type=float, default=0.0)
+        parser.add_argument(f"--{route}-fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    options = {f"{route}_{name}": getattr(args, f"{route}_{name}") for route in ROUTES for name in ("delay", "fail_rate")}
+    image_bytes = make_png(args.image_size, args.image_size, noise=True)
+    with StubServer(image_bytes=image_bytes, jitter=args.jitter, port=args.port,
+                    chat_token_delay=args.chat_token_delay, **options) as server:
+        print(f"Stub APIs listening on {server.url} ({len(image_bytes)} byte images)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
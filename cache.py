@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import metrics
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "1") != "0"
+GENERATION_CACHE_DIR = os.getenv("GENERATION_CACHE_DIR", os.path.join(".cache", "generations"))
+GENERATION_CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+GENERATION_CACHE_TTL = float(os.getenv("GENERATION_CACHE_TTL", str(7 * 24 * 3600)))
+
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+# Set to a directory to keep expanded prompts across restarts
+PROMPT_CACHE_DIR = os.getenv("PROMPT_CACHE_DIR")
+PROMPT_CACHE_MAX_BYTES = int(os.getenv("PROMPT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+cache_requests = metrics.counter("imagen_cache_requests_total", "Cache lookups by cache and result")
+
+def cache_key(*parts):
+    # Canonical JSON so that dict ordering never changes the key
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+class DiskCache:
+    """Stores lists of blobs plus JSON metadata on disk, one directory per key.
+
+    Entries expire after `ttl` seconds and the least recently used ones are
+    evicted once the cache grows beyond `max_bytes`.
+    """
+
+    def __init__(self, name, directory, max_bytes, ttl=None):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), "r") as f:
+                meta = json.load(f)
+            if self.ttl is not None and time.time() - meta["created"] > self.ttl:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                raise FileNotFoundError(entry_dir)
+            blobs = []
+            for name in meta["files"]:
+                with open(os.path.join(entry_dir, name), "rb") as f:
+                    blobs.append(f.read())
+            os.utime(entry_dir)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            cache_requests.inc(cache=self.name, result="miss")
+            return None
+        with self._lock:
+            self.hits += 1
+        cache_requests.inc(cache=self.name, result="hit")
+        return blobs, meta["meta"]
+
+    def set(self, key, blobs, meta=None, extension="bin"):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_dir = os.path.join(self.directory, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        try:
+            files = []
+            for i, blob in enumerate(blobs):
+                # Each blob is either bytes or the path of a file to copy
+                name = f"{i}.{extension}"
+                if isinstance(blob, (str, os.PathLike)):
+                    shutil.copyfile(blob, os.path.join(tmp_dir, name))
+                else:
+                    with open(os.path.join(tmp_dir, name), "wb") as f:
+                        f.write(blob)
+                files.append(name)
+            with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+                json.dump({"created": time.time(), "files": files, "meta": meta}, f)
+            entry_dir = self._entry_dir(key)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError as e:
+            logger.error(f"Error writing cache entry {key}: {str(e)}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name.startswith(".tmp-"):
+                continue
+            try:
+                with open(os.path.join(entry.path, "meta.json"), "r") as f:
+                    created = json.load(f)["created"]
+                mtime = entry.stat().st_mtime
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            except (OSError, ValueError, KeyError):
+                continue
+            if self.ttl is not None and now - created > self.ttl:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            entries.append((mtime, size, entry.path))
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+generation_cache = DiskCache("generation", GENERATION_CACHE_DIR, GENERATION_CACHE_MAX_BYTES, GENERATION_CACHE_TTL)
+
+class MemoryCache:
+    """Bounded in-memory LRU of JSON-serialisable values.
+
+    With a `backing` DiskCache, values are also persisted there and read
+    back on an in-memory miss.
+    """
+
+    def __init__(self, name, max_items, backing=None):
+        self.name = name
+        self.max_items = max_items
+        self.backing = backing
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                cache_requests.inc(cache=self.name, result="hit")
+                return self._items[key]
+        if self.backing is not None:
+            cached = self.backing.get(key)
+            if cached is not None:
+                value = json.loads(cached[0])
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                cache_requests.inc(cache=self.name, result="hit")
+                return value
+        with self._lock:
+            self.misses += 1
+        cache_requests.inc(cache=self.name, result="miss")
+        return None
+
+    def set(self, key, value):
+        self._store(key, value)
+        if self.backing is not None:
+            self.backing.set(key, [json.dumps(value).encode()], extension="json")
+
+    def _store(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+prompt_cache = MemoryCache(
+    "prompt",
+    PROMPT_CACHE_SIZE,
+    DiskCache("prompt_disk", PROMPT_CACHE_DIR, PROMPT_CACHE_MAX_BYTES) if PROMPT_CACHE_DIR else None
+)
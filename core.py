@@ -0,0 +1,460 @@
+import json
+import time
+import logging
+import os
+import encoding
+import http_client
+import metrics
+import ratelimit
+from cache import GENERATION_CACHE_ENABLED, cache_key, generation_cache, prompt_cache
+from image_record import ImageRecord, detect_format
+import upscalers
+import hashlib
+import uuid
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Constants
+BASE_URL = os.getenv("AIML_API_BASE_URL", "https://api.aimlapi.com")
+IMAGE_GEN_URL = f"{BASE_URL}/images/generations"
+CHAT_URL = f"{BASE_URL}/chat/completions"
+IMAGE_MODEL = "flux-pro"
+CHAT_MODEL = "gpt-4o-2024-08-06"
+
+# Maximum number of images downloaded (and upscaled) in parallel
+MAX_IMAGE_WORKERS = int(os.getenv("MAX_IMAGE_WORKERS", "4"))
+
+# Most images the API returns for one request
+MAX_NUM_IMAGES = 4
+# Maximum number of sweep variants requested from the API at the same time
+MAX_VARIANT_WORKERS = int(os.getenv("MAX_VARIANT_WORKERS", "4"))
+
+OUTPUT_FOLDER = "generated_images"
+
+# Downloads are streamed to disk in chunks and aborted past the size limit
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(64 * 1024 * 1024)))
+PARTIAL_DOWNLOAD_PREFIX = ".download_"
+
+# API key
+API_KEY = os.getenv("API_KEY")
+
+IMAGE_SIZES = {
+    "square_hd": "Square HD",
+    "square": "Square",
+    "portrait_4_3": "Portrait 4:3",
+    "portrait_16_9": "Portrait 16:9",
+    "landscape_4_3": "Landscape 4:3",
+    "landscape_16_9": "Landscape 16:9"
+}
+
+SYSTEM_PROMPT = """Objective:
+This system will generate creative and detailed AI image prompts based on a user's description, emulating the distinctive style and structure observed in a comprehensive set of user-provided example prompts. The system will aim for accuracy, detail, and flexibility, ensuring the generated prompts are suitable for use with AI image generators like Midjourney, Stable Diffusion, and DALL-E.
+
+Core Principles:
+
+    Faithful Style Replication: The system will prioritize mirroring the nuanced style of the user's examples. This includes:
+
+        Concise Subject Introduction: Starting with a clear and brief subject or scene description.
+
+        Varied Style Keywords: Incorporating a diverse range of keywords related to art style, photography techniques, and desired aesthetics (e.g., "cinematic," "Pixar-style," "photorealistic," "minimalist," "surrealism").
+
+        Artistic References: Integrating specific artists, art movements, or pop culture references to guide the AI's stylistic interpretation.
+
+        Optional Technical Details: Including optional yet specific details about:
+
+            Camera and Lens: "Canon EOS R5," "Nikon D850 with a macro lens," "35mm lens at f/8."
+
+            Film Stock: "Kodak film," "Fujifilm Provia."
+
+            Post-Processing: "Film grain," "lens aberration," "color negative," "bokeh."
+
+        AI Model Parameters: Adding relevant parameters like aspect ratio ("--ar 16:9"), stylization ("--stylize 750"), chaos ("--s 750"), or version ("--v 6.0").
+
+        Negative Prompts: Employing negative prompts to exclude undesired elements.
+
+        Emphasis Techniques: Utilizing parentheses, brackets, or capitalization to highlight key elements within the prompt.
+
+    User-Centric Design:
+
+        Clarity and Specificity: The generated prompts should be clear, specific, and easily understood by the AI.
+
+        Open-Ended Options: Allow for open-ended descriptions when users seek more creative freedom.
+
+        Iterative Refinement: Support modifications and adjustments based on user feedback to facilitate an iterative creation process.
+
+    Comprehensive Prompt Structure:
+
+        Subject: Clearly define the primary subject(s) of the image.
+
+        Action/Pose: Describe actions or poses the subject(s) might be performing.
+
+        Environment/Background: Establish the scene's setting, including background elements.
+
+        Style/Art Medium: Specify the desired artistic style or medium (photography, illustration, painting, pixel art, etc.).
+
+        Lighting: Detail the lighting conditions (soft light, dramatic light, natural light, studio lighting, etc.).
+
+        Color Palette: Suggest a specific color palette or individual colors.
+
+        Composition: Indicate the preferred composition (close-up, wide-angle, symmetrical, minimalist, etc.).
+
+        Details/Texture: Include descriptions of textures, patterns, and specific features.
+
+        Mood/Atmosphere: Optionally evoke a mood or atmosphere to guide the AI's interpretation (melancholic, mysterious, serene, etc.).
+
+Example Interaction:
+
+User Input: "A portrait of a futuristic robot, with neon lights reflecting on its metallic surface, in a cyberpunk city."
+
+System Output:
+"Portrait of a futuristic robot, neon lights reflecting on its metallic surface, standing in a cyberpunk city, detailed circuitry, glowing eyes, (gritty), (cyberpunk aesthetic), in the style of Syd Mead, cinematic lighting, 85mm lens, film grain, --ar 3:2 --v 6.0 --style raw"
+
+Generate a prompt based on the user's input."""
+
+SYSTEM_PROMPT_HASH = hashlib.sha256(SYSTEM_PROMPT.encode()).hexdigest()
+
+PROMPT_FAILED_MESSAGE = "Failed to generate prompt. Please try again later."
+
+prompt_first_token_seconds = metrics.histogram("imagen_prompt_first_token_seconds", "Time until the first streamed prompt token arrives")
+
+# Concurrent identical requests share a single upstream call
+prompt_flight = ratelimit.SingleFlight("generate_prompt")
+image_flight = ratelimit.SingleFlight("generate_image")
+prompt_stream_flight = ratelimit.StreamFlight("stream_prompt")
+
+def prompt_payload(user_input, temperature):
+    return {
+        "model": CHAT_MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_input}
+        ],
+        "max_tokens": 150,
+        "temperature": temperature
+    }
+
+def generate_prompt(user_input, fresh=False, temperature=1):
+    # Identical input returns the previous expansion unless a fresh one is asked for
+    key = cache_key(CHAT_MODEL, SYSTEM_PROMPT_HASH, user_input, temperature)
+    if not fresh:
+        cached = prompt_cache.get(key)
+        if cached is not None:
+            return cached
+
+    payload = prompt_payload(user_input, temperature)
+    if fresh:
+        return request_prompt(payload, key)
+    return prompt_flight.do(key, request_prompt, payload, key)
+
+def request_prompt(payload, key):
+    headers = {
+        "Authorization": f"Bearer {API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    try:
+        ratelimit.acquire("chat")
+        with metrics.span("generate_prompt"):
+            response = http_client.post(CHAT_URL, json=payload, headers=headers)
+            response.raise_for_status()
+            generated_prompt = response.json()['choices'][0]['message']['content']
+        prompt_cache.set(key, generated_prompt)
+        return generated_prompt
+    except http_client.RequestException as e:
+        error_message = f"Error generating prompt: {str(e)}"
+        if hasattr(e.response, 'text'):
+            error_message += f"\nResponse content: {e.response.text}"
+        logger.error(error_message)
+        return PROMPT_FAILED_MESSAGE
+
+def stream_prompt(user_input, fresh=False, temperature=1):
+    # Like generate_prompt, but yields the text as the model writes it.
+    # Identical requests in flight share one stream, see ratelimit.StreamFlight
+    key = cache_key(CHAT_MODEL, SYSTEM_PROMPT_HASH, user_input, temperature)
+    if not fresh:
+        cached = prompt_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    payload = {**prompt_payload(user_input, temperature), "stream": True}
+    if fresh:
+        yield from request_prompt_stream(payload, key)
+        return
+    yield from prompt_stream_flight.stream(key, request_prompt_stream, payload, key,
+                                           aborted=f"\n\n{PROMPT_FAILED_MESSAGE}")
+
+def request_prompt_stream(payload, key):
+    # The full text is cached once the stream has completed with [DONE]
+    headers = {
+        "Authorization": f"Bearer {API_KEY}",
+        "Content-Type": "application/json"
+    }
+    parts = []
+
+    try:
+        ratelimit.acquire("chat")
+        with metrics.span("generate_prompt_stream"):
+            start = time.perf_counter()
+            response = http_client.post(CHAT_URL, json=payload, headers=headers, stream=True)
+            try:
+                response.raise_for_status()
+                for data in http_client.iter_sse(response):
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or [{}]
+                    text = choices[0].get("delta", {}).get("content")
+                    if text:
+                        if not parts:
+                            prompt_first_token_seconds.observe(time.perf_counter() - start)
+                        parts.append(text)
+                        yield text
+                else:
+                    raise ValueError("Stream ended before [DONE]")
+            finally:
+                response.close()
+    except (http_client.RequestException, ValueError) as e:
+        error_message = f"Error streaming prompt: {str(e)}"
+        if hasattr(getattr(e, 'response', None), 'text'):
+            error_message += f"\nResponse content: {e.response.text}"
+        logger.error(error_message)
+        # A stream cut off midway is reported as a failure too, never cached
+        yield ("\n\n" if parts else "") + PROMPT_FAILED_MESSAGE
+        return
+    if parts:
+        prompt_cache.set(key, "".join(parts))
+
+def upscale_image(record, version="v1.4", scale_factor=2):
+    # Routed to the fastest healthy upscaler backend, see upscalers.py
+    ratelimit.acquire("upscale")
+    with metrics.span("upscale") as span:
+        upscaled_record = upscalers.upscale_router.upscale(record, version, scale_factor)
+        if upscaled_record is None:
+            span.fail()
+    return upscaled_record
+
+@metrics.timed("image_download")
+def download_image(image_url, max_bytes=MAX_DOWNLOAD_BYTES):
+    # Streams into a hidden file in OUTPUT_FOLDER that save_images later renames
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    path = os.path.join(OUTPUT_FOLDER, f"{PARTIAL_DOWNLOAD_PREFIX}{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    header = b""
+    size = 0
+
+    image_response = http_client.get(image_url, stream=True)
+    try:
+        image_response.raise_for_status()
+        content_length = image_response.headers.get("Content-Length")
+        if content_length and int(content_length) > max_bytes:
+            raise ValueError(f"Image is {content_length} bytes, over the {max_bytes} byte limit")
+        with open(path, "wb") as f:
+            for chunk in image_response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"Image is over the {max_bytes} byte limit")
+                if len(header) < 16:
+                    header += chunk[:16]
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        image_response.close()
+
+    return ImageRecord.from_file(path, detect_format(header), digest.hexdigest())
+
+def fetch_image(image_url, upscale=False):
+    record = download_image(image_url)
+
+    if upscale:
+        upscaled_record = upscale_image(record)
+        if upscaled_record:
+            os.remove(record.path)  # Only the upscaled version is kept
+            return upscaled_record
+        # Fallback to original if upscaling fails
+    return record
+
+def share_images(result):
+    # Callers sharing a coalesced request get their own in-memory records, since
+    # save_images moves the downloaded files of the original ones
+    images, image_urls, error = result
+    if images:
+        images = [ImageRecord(image.data, image.format, sha256=image.sha256) for image in images]
+    return images, image_urls, error
+
+def generate_image(prompt, size, steps, guidance, num_images, seed, safety_tolerance, sync_mode, upscale=False, max_workers=MAX_IMAGE_WORKERS, on_image=None):
+    payload = {
+        "model": IMAGE_MODEL,
+        "prompt": prompt,
+        "image_size": size,
+        "num_inference_steps": steps,
+        "guidance_scale": guidance,
+        "num_images": num_images,
+        "safety_tolerance": safety_tolerance,
+        "sync_mode": sync_mode
+    }
+    if seed is not None:
+        payload["seed"] = seed
+
+    # Only seeded requests are deterministic, so only those are cached
+    key = cache_key(payload, upscale)
+    cacheable = GENERATION_CACHE_ENABLED and seed is not None
+    if cacheable:
+        cached = generation_cache.get(key)
+        if cached is not None:
+            blobs, image_urls = cached
+            images = [ImageRecord(blob) for blob in blobs]
+            if on_image:
+                for i, image in enumerate(images):
+                    on_image(i, image)
+            return images, image_urls, None
+
+    return image_flight.do(key, request_images, payload, upscale, key if cacheable else None, max_workers, on_image,
+                           share=share_images)
+
+def request_images(payload, upscale, key, max_workers, on_image=None):
+    # key is where a fully successful result is cached, or None. on_image(index, record)
+    # is called as each image arrives; callers sharing a coalesced request only get the result
+    headers = {
+        "Authorization": f"Bearer {API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    try:
+        ratelimit.acquire("image")
+        with metrics.span("image_generation_request"):
+            response = http_client.post(IMAGE_GEN_URL, json=payload, headers=headers)
+            response.raise_for_status()
+            image_urls = [image_data['url'] for image_data in response.json()['images']]
+    except http_client.RequestException as e:
+        error_message = f"Error generating image: {str(e)}"
+        if hasattr(e.response, 'text'):
+            error_message += f"\nResponse content: {e.response.text}"
+        logger.error(error_message)
+        return None, None, "Failed to generate image. Please check the terminal for detailed error messages."
+
+    if not image_urls:
+        return [], [], None
+
+    # Download (and upscale) every image concurrently, keeping the API's order
+    results = [None] * len(image_urls)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(image_urls)))) as executor:
+        # Each task runs in a copy of this context so upscales keep the caller's rate limit session
+        futures = {executor.submit(contextvars.copy_context().run, fetch_image, url, upscale): i
+                   for i, url in enumerate(image_urls)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                error_message = f"Error fetching image {image_urls[i]}: {str(e)}"
+                logger.error(error_message)
+                continue
+            if on_image:
+                on_image(i, results[i])
+
+    images = [image for image in results if image is not None]
+    fetched_urls = [url for url, image in zip(image_urls, results) if image is not None]
+    failed = len(image_urls) - len(images)
+    if not failed:
+        if key is not None:
+            generation_cache.set(key, [image.path or image.data for image in images], fetched_urls, extension="img")
+        return images, fetched_urls, None
+    error = f"Failed to download {failed} of {len(image_urls)} images. Please check the terminal for detailed error messages."
+    if not images:
+        return None, None, error
+    return images, fetched_urls, error
+
+def sweep_variants(base, parameter=None, values=()):
+    # One variant (a dict of seed, guidance and steps) per swept value
+    if parameter is None or not values:
+        return [dict(base)]
+    return [{**base, parameter: value} for value in values]
+
+def generate_variants(prompt, size, variants, num_images, safety_tolerance, sync_mode, upscale=False,
+                      on_image=None, max_workers=MAX_VARIANT_WORKERS):
+    """Requests every variant concurrently, each asking for num_images images.
+
+    Returns one (images, error) pair per variant, in order. on_image(variant
+    index, image index, record) is called as each image arrives.
+    """
+    def run(index, variant):
+        callback = (lambda i, image: on_image(index, i, image)) if on_image else None
+        images, _, error = generate_image(
+            prompt, size, variant["steps"], variant["guidance"], num_images, variant.get("seed"),
+            safety_tolerance, sync_mode, upscale, on_image=callback
+        )
+        return images or [], error
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(variants)))) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run, i, variant) for i, variant in enumerate(variants)]
+        results, failure = [], None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                failure = failure or e
+                results.append(([], None))
+    if failure is not None:
+        # The other variants' images will not be saved either
+        discard_images([image for images, _ in results for image in images])
+        raise failure
+    return results
+
+def discard_images(images):
+    # Deletes the downloaded files of records that are not going to be saved.
+    # Records already saved (or never written to disk) are left alone
+    for image in images:
+        if image.path is not None and os.path.basename(image.path).startswith(PARTIAL_DOWNLOAD_PREFIX):
+            try:
+                os.remove(image.path)
+            except FileNotFoundError:
+                pass
+            image.path = None
+
+def log_generated_image(image_path, prompt):
+    logger.info(f"Generated Image: {image_path}")
+    logger.info(f"Prompt: {prompt}")
+
+@metrics.timed("save_images")
+def save_images(images, prompt, prefix="generated_image"):
+    output_folder = OUTPUT_FOLDER
+    os.makedirs(output_folder, exist_ok=True)
+    import image_index  # Loads NumPy, so only on the first save
+    saved_paths = []
+    # Concurrent callers can save within the same second, so add a batch token
+    batch_id = uuid.uuid4().hex[:8]
+    # Re-encoded in parallel when ARCHIVE_ENCODING is set, see encoding.py
+    archived = encoding.encode_all(images, "archive")
+    for i, (image, stored) in enumerate(zip(images, archived)):
+        timestamp = int(time.time())
+        filename = f"{prefix}_{timestamp}_{batch_id}_{i+1}.{stored.extension}"
+        filepath = os.path.join(output_folder, filename)
+        if stored is not image:
+            image.data  # The record keeps the received bytes, its path moves to the archived copy
+            stored.write_to(filepath)
+            if image.path is not None and os.path.basename(image.path).startswith(PARTIAL_DOWNLOAD_PREFIX):
+                os.remove(image.path)
+            image.path = filepath
+        elif image.path is not None and os.path.basename(image.path).startswith(PARTIAL_DOWNLOAD_PREFIX):
+            # Already streamed into the output folder, just give it its final name
+            os.replace(image.path, filepath)
+            image.path = filepath
+        else:
+            image.write_to(filepath)
+            image.path = filepath
+        saved_paths.append(filepath)
+        log_generated_image(filepath, prompt)
+    image_index.add_images([(path, stored.sha256, prompt) for path, stored in zip(saved_paths, archived)])
+    return saved_paths
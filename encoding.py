@@ -0,0 +1,121 @@
+"""Output encodings for the places images are written to.
+
+Images are kept in the format the API returned them in unless an encoding is
+configured for the destination:
+
+- ARCHIVE_ENCODING: files in generated_images/ (save_images, upscaled images)
+- HISTORY_ENCODING: full-size images in history_images/
+- DOWNLOAD_ENCODING: images offered as downloads in the UI
+
+An encoding is `original` or a format with an optional setting: `png:9`
+(zlib level 0-9), `webp:85` or `webp:lossless`, `jpeg:90`, `avif:60`.
+AVIF falls back to WebP, and WebP to JPEG, when Pillow cannot write it.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+import metrics
+from image_record import ImageRecord
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+ENCODINGS = {
+    "archive": os.getenv("ARCHIVE_ENCODING", "original"),
+    "history": os.getenv("HISTORY_ENCODING", "original"),
+    "download": os.getenv("DOWNLOAD_ENCODING", "original")
+}
+# Pillow releases the GIL while compressing, so threads encode in parallel
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+DEFAULT_QUALITY = {"WEBP": 85, "JPEG": 90, "AVIF": 60}
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+FALLBACK_FORMATS = {"AVIF": "WEBP", "WEBP": "JPEG"}
+
+encode_seconds = metrics.histogram("imagen_encode_seconds", "Time spent re-encoding an image")
+encoded_bytes = metrics.counter("imagen_encoded_bytes_total", "Bytes of images before and after re-encoding")
+
+def parse_encoding(spec):
+    # Returns (format, save options), or None to keep images as they are
+    name, _, setting = spec.strip().lower().partition(":")
+    if name in ("", "original"):
+        return None
+    format = "JPEG" if name == "jpg" else name.upper()
+    if format == "PNG":
+        return format, {"compress_level": int(setting) if setting else DEFAULT_PNG_COMPRESS_LEVEL}
+    if format == "WEBP" and setting == "lossless":
+        return format, {"lossless": True}
+    if format in DEFAULT_QUALITY:
+        return format, {"quality": int(setting) if setting else DEFAULT_QUALITY[format]}
+    raise ValueError(f"Unsupported image encoding: {spec}")
+
+def can_save(format):
+    from PIL import Image
+    Image.init()
+    return format in Image.SAVE
+
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+def resolve_encoding(destination, spec=None):
+    # Parsed and checked against Pillow once per destination
+    key = (destination, spec)
+    with _resolved_lock:
+        if key not in _resolved:
+            encoding = parse_encoding(spec if spec is not None else ENCODINGS[destination])
+            while encoding is not None and not can_save(encoding[0]):
+                fallback = FALLBACK_FORMATS.get(encoding[0], "PNG")
+                logger.warning(f"Pillow cannot write {encoding[0]}, saving {destination} images as {fallback}")
+                encoding = parse_encoding(fallback)
+            _resolved[key] = encoding
+        return _resolved[key]
+
+def encode(record, destination, spec=None):
+    """Returns the record re-encoded for destination, or the record itself.
+
+    `spec` overrides the configured encoding. If encoding fails the original
+    record is returned, so an image is never lost over its format.
+    """
+    encoding = resolve_encoding(destination, spec)
+    if record is None or encoding is None:
+        return record
+    format, options = encoding
+    try:
+        start = time.perf_counter()
+        image = record.image
+        if format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+        encoded = ImageRecord.from_image(image, format, **options)
+        encode_seconds.observe(time.perf_counter() - start, destination=destination, format=format)
+        encoded_bytes.inc(len(record.data), destination=destination, stage="in")
+        encoded_bytes.inc(len(encoded.data), destination=destination, stage="out")
+        return encoded
+    except Exception as e:
+        logger.error(f"Error encoding image as {format} for {destination}: {str(e)}")
+        return record
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+        return _executor
+
+def encode_async(record, destination, spec=None):
+    # Returns a future of the encoded record
+    return executor().submit(encode, record, destination, spec)
+
+def encode_all(records, destination, spec=None):
+    records = list(records)
+    if resolve_encoding(destination, spec) is None or len(records) < 2:
+        return [encode(record, destination, spec) for record in records]
+    return list(executor().map(encode, records, repeat(destination), repeat(spec)))
@@ -0,0 +1,133 @@
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+import metrics
+
+# Load environment variables
+load_dotenv()
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Timeouts in seconds; a hung upstream must never block a worker forever
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+
+# Retry with exponential backoff and full jitter
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "10"))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Resending these is harmless even if the first attempt reached the upstream
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# Keep-alive connections kept open per host
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+
+http_requests = metrics.counter("imagen_http_requests_total", "HTTP requests by host and status code")
+http_retries = metrics.counter("imagen_http_retries_total", "HTTP requests retried by host")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(url):
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            # requests takes ~100ms to import, so it is loaded on the first request
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount(f"{parts.scheme}://", adapter)
+            _sessions[key] = session
+        return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def backoff_delay(attempt, response=None):
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(BACKOFF_MAX, float(retry_after))
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def connect_failed(error):
+    # True when the request never reached the upstream, so resending it cannot duplicate it
+    import requests
+    from urllib3.exceptions import ConnectTimeoutError
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)  # Includes NewConnectionError
+
+def request(method, url, max_retries=MAX_RETRIES, **kwargs):
+    import requests
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    session = get_session(url)
+    host = urlsplit(url).netloc
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            http_requests.inc(host=host, status="error")
+            # A POST whose connection broke after it was sent may already have been
+            # accepted (and billed), so only failures to connect are retried for it.
+            # Read timeouts are never retried since the upstream may still be working
+            if attempt == max_retries or (method.upper() not in IDEMPOTENT_METHODS and not connect_failed(e)):
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(f"{method} {url} failed ({str(e)}), retrying in {delay:.2f}s")
+        else:
+            http_requests.inc(host=host, status=response.status_code)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                return response
+            delay = backoff_delay(attempt, response)
+            logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.2f}s")
+            response.close()
+        http_retries.inc(host=host)
+        time.sleep(delay)
+
+def iter_sse(response):
+    # Yields the data of each server-sent event as soon as its blank line arrives.
+    # chunk_size=None hands over each chunk as received instead of waiting to fill a buffer
+    data = []
+    for line in response.iter_lines(chunk_size=None):
+        line = line.decode("utf-8")
+        if not line:
+            if data:
+                yield "\n".join(data)
+                data = []
+            continue
+        if line.startswith(":"):
+            continue  # Comment, used as keep-alive
+        field, _, value = line.partition(":")
+        if field == "data":
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield "\n".join(data)
+
+def __getattr__(name):
+    # Lets callers write `except http_client.RequestException` without importing requests up front
+    if name == "RequestException":
+        import requests
+        return requests.exceptions.RequestException
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
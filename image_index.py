@@ -0,0 +1,269 @@
+"""Index of saved images by content hash, perceptual hash and prompt.
+
+Every image written by save_images is added with its sha256 (exact
+duplicates) and a 64-bit dHash (near duplicates: resized, re-encoded or
+slightly edited copies differ in only a few bits). Existing folders can be
+indexed incrementally with `python image_index.py reindex`.
+"""
+import argparse
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+IMAGE_INDEX_DB = os.getenv("IMAGE_INDEX_DB", "image_index.db")
+IMAGE_INDEX_ENABLED = os.getenv("IMAGE_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+
+# dHash compares neighbouring pixels of a 9x8 grayscale thumbnail: 64 bits
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+# Images whose hashes differ in at most this many bits count as near duplicates
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("NEAR_DUPLICATE_DISTANCE", "10"))
+REINDEX_BATCH_SIZE = 500
+
+def connect():
+    conn = sqlite3.connect(IMAGE_INDEX_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            dhash INTEGER NOT NULL,
+            prompt TEXT,
+            size INTEGER,
+            mtime REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)")
+    conn.execute("CREATE INDEX IF NOT EXISTS images_prompt ON images (prompt)")
+    # Bumped by every write, from any process, so cached hashes know when they are stale
+    conn.execute("CREATE TABLE IF NOT EXISTS index_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS images_{event.lower()} AFTER {event} ON images
+            BEGIN UPDATE index_version SET version = version + 1; END
+        """)
+    conn.execute("INSERT OR IGNORE INTO index_version (id, version) VALUES (0, 0)")
+    conn.commit()
+    return conn
+
+def dhash_pixels(pixels):
+    # pixels: (..., HASH_HEIGHT, HASH_WIDTH) grayscale arrays, so many images hash in one call
+    bits = pixels[..., 1:] > pixels[..., :-1]
+    packed = np.packbits(bits.reshape(*bits.shape[:-2], 64), axis=-1)
+    # SQLite integers are signed 64-bit
+    return packed.view(">i8").reshape(bits.shape[:-2])
+
+def dhash(image):
+    from PIL import Image
+    if image.format == "JPEG":
+        image.draft("L", (HASH_WIDTH * 8, HASH_HEIGHT * 8))  # Decode at reduced size
+    small = image.convert("L").resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.BOX)
+    pixels = np.asarray(small, dtype=np.int16)
+    return int(dhash_pixels(pixels))
+
+def hash_file(path):
+    # Runs in reindex worker processes
+    from PIL import Image
+    with open(path, "rb") as f:
+        data = f.read()
+    stat = os.stat(path)
+    with Image.open(io.BytesIO(data)) as image:
+        image_dhash = dhash(image)
+    return path, hashlib.sha256(data).hexdigest(), image_dhash, stat.st_size, stat.st_mtime
+
+def hamming_distances(hashes, query):
+    xor = np.bitwise_xor(hashes, np.int64(query)).view(np.uint64)
+    return np.bitwise_count(xor) if hasattr(np, "bitwise_count") else np.unpackbits(xor.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+def add_images(entries):
+    # entries are (path, sha256 or None, prompt) for files already written
+    if not IMAGE_INDEX_ENABLED:
+        return
+    rows = []
+    for path, sha256, prompt in entries:
+        try:
+            path, file_sha256, image_dhash, size, mtime = hash_file(path)
+        except Exception as e:
+            logger.error(f"Error indexing {path}: {str(e)}")
+            continue
+        rows.append((os.path.normpath(path), sha256 or file_sha256, image_dhash, prompt, size, mtime))
+    with connect() as conn:
+        conn.executemany("INSERT OR REPLACE INTO images (path, sha256, dhash, prompt, size, mtime) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.close()
+
+_hash_cache = {"version": None, "paths": [], "hashes": np.empty(0, dtype=np.int64)}
+_hash_cache_lock = threading.Lock()
+
+def load_hashes(conn):
+    # Hashes stay in memory between queries until the table changes
+    version = conn.execute("SELECT version FROM index_version").fetchone()[0]
+    with _hash_cache_lock:
+        if _hash_cache["version"] != version:
+            rows = conn.execute("SELECT path, dhash FROM images").fetchall()
+            _hash_cache["paths"] = [row["path"] for row in rows]
+            _hash_cache["hashes"] = np.fromiter((row["dhash"] for row in rows), dtype=np.int64, count=len(rows))
+            _hash_cache["version"] = version
+        return _hash_cache["paths"], _hash_cache["hashes"]
+
+def find_duplicates(sha256):
+    conn = connect()
+    try:
+        return [dict(row) for row in conn.execute("SELECT * FROM images WHERE sha256 = ?", (sha256,))]
+    finally:
+        conn.close()
+
+def find_similar(query_dhash, max_distance=NEAR_DUPLICATE_DISTANCE, limit=20):
+    # Returns (distance, row) pairs, closest first
+    conn = connect()
+    try:
+        paths, hashes = load_hashes(conn)
+        if not paths:
+            return []
+        distances = hamming_distances(hashes, query_dhash)
+        matches = np.flatnonzero(distances <= max_distance)
+        matches = matches[np.argsort(distances[matches], kind="stable")][:limit]
+        results = []
+        for i in matches:
+            row = conn.execute("SELECT * FROM images WHERE path = ?", (paths[i],)).fetchone()
+            if row is not None:
+                results.append((int(distances[i]), dict(row)))
+        return results
+    finally:
+        conn.close()
+
+def find_similar_to_file(path, max_distance=NEAR_DUPLICATE_DISTANCE, limit=20):
+    _, _, query_dhash, _, _ = hash_file(path)
+    return [(distance, row) for distance, row in find_similar(query_dhash, max_distance, limit + 1)
+            if row["path"] != path][:limit]
+
+def find_by_prompt(text, limit=50):
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT * FROM images WHERE prompt = ? UNION ALL "
+            "SELECT * FROM (SELECT * FROM images WHERE prompt LIKE ? AND prompt != ? ORDER BY mtime DESC) LIMIT ?",
+            (text, f"%{text}%", text, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+def history_prompts(sha256s):
+    # Files indexed after the fact get their prompt from the history, matched by content
+    import storage
+    if not sha256s or not os.path.exists(storage.HISTORY_DB):
+        return {}
+    conn = storage.connect()
+    try:
+        prompts = {}
+        sha256s = list(sha256s)
+        for start in range(0, len(sha256s), 500):
+            chunk = sha256s[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(f"SELECT image_hash, prompt FROM history WHERE image_hash IN ({placeholders})", chunk):
+                prompts[row["image_hash"]] = row["prompt"]
+        return prompts
+    finally:
+        conn.close()
+
+def reindex(folder, processes=None):
+    """Brings the index in line with the image files in folder.
+
+    Only new files and files whose size or mtime changed are hashed, in a
+    process pool; rows for deleted files are removed. Returns the number of
+    files (re)indexed and removed.
+    """
+    conn = connect()
+    try:
+        known = {row["path"]: (row["size"], row["mtime"]) for row in conn.execute("SELECT path, size, mtime FROM images")}
+    finally:
+        conn.close()
+
+    changed = []
+    present = set()
+    for entry in os.scandir(folder):
+        if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        path = os.path.normpath(entry.path)
+        present.add(path)
+        stat = entry.stat()
+        if known.get(path) != (stat.st_size, stat.st_mtime):
+            changed.append(path)
+    removed = [path for path in known if path not in present and os.path.dirname(path) == os.path.normpath(folder)]
+
+    indexed = 0
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(safe_hash_file, changed, chunksize=32)
+        batch = []
+        for result in results:
+            if result is not None:
+                batch.append(result)
+            if len(batch) >= REINDEX_BATCH_SIZE:
+                indexed += write_reindexed(batch)
+                batch = []
+        indexed += write_reindexed(batch)
+
+    if removed:
+        with connect() as conn:
+            conn.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in removed])
+        conn.close()
+    return indexed, len(removed)
+
+def safe_hash_file(path):
+    try:
+        return hash_file(path)
+    except Exception as e:
+        logger.error(f"Error indexing {path}: {str(e)}")
+        return None
+
+def write_reindexed(batch):
+    if not batch:
+        return 0
+    prompts = history_prompts({sha256 for _, sha256, _, _, _ in batch})
+    rows = [(path, sha256, image_dhash, prompts.get(sha256), size, mtime) for path, sha256, image_dhash, size, mtime in batch]
+    with connect() as conn:
+        # Keep a prompt recorded at save time if the history has none
+        conn.executemany("""
+            INSERT INTO images (path, sha256, dhash, prompt, size, mtime) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET sha256 = excluded.sha256, dhash = excluded.dhash,
+                prompt = COALESCE(excluded.prompt, images.prompt), size = excluded.size, mtime = excluded.mtime
+        """, rows)
+    conn.close()
+    return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Index generated images and search for duplicates.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    reindex_parser = subparsers.add_parser("reindex", help="index new and changed files in a folder")
+    reindex_parser.add_argument("folder", nargs="?", default="generated_images")
+    reindex_parser.add_argument("--processes", type=int, default=None)
+    similar_parser = subparsers.add_parser("similar", help="list indexed images that look like a file")
+    similar_parser.add_argument("path")
+    similar_parser.add_argument("--distance", type=int, default=NEAR_DUPLICATE_DISTANCE)
+    prompt_parser = subparsers.add_parser("prompt", help="list indexed images generated from a prompt")
+    prompt_parser.add_argument("text")
+    args = parser.parse_args()
+
+    if args.command == "reindex":
+        indexed, removed = reindex(args.folder, args.processes)
+        print(f"Indexed {indexed} images, removed {removed} missing ones")
+    elif args.command == "similar":
+        for distance, row in find_similar_to_file(args.path, args.distance):
+            print(f"{distance:2d}  {row['path']}")
+    else:
+        for row in find_by_prompt(args.text):
+            print(f"{row['path']}  {row['prompt']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import base64
+import shutil
+from io import BytesIO
+
+# Leading bytes of the formats the APIs return
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF8", "GIF"),
+]
+
+EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp", "GIF": "gif", "AVIF": "avif"}
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif", "AVIF": "image/avif"}
+
+def detect_format(data):
+    for signature, format in SIGNATURES:
+        if data.startswith(signature):
+            return format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    if data[4:12] == b"ftypavif":
+        return "AVIF"
+    return None
+
+class ImageRecord:
+    """An encoded image as received, decoded to a PIL image only when needed.
+
+    Saving, caching, uploading and downloading all use `data` directly, so
+    an image is never re-encoded just to move it around. A record can also
+    be backed by a file, in which case the bytes are only read into memory
+    when `data` is used.
+    """
+
+    def __init__(self, data, format=None, path=None, sha256=None):
+        self._data = data
+        self.path = path
+        self.sha256 = sha256
+        self.format = format or (detect_format(data[:16]) if data is not None else None) or "PNG"
+        self._image = None
+
+    @classmethod
+    def from_file(cls, path, format=None, sha256=None):
+        if format is None:
+            with open(path, "rb") as f:
+                format = detect_format(f.read(16))
+        return cls(None, format, path, sha256)
+
+    @classmethod
+    def from_image(cls, image, format="PNG", **save_options):
+        buffered = BytesIO()
+        image.save(buffered, format=format, **save_options)
+        record = cls(buffered.getvalue(), format)
+        record._image = image
+        return record
+
+    @property
+    def data(self):
+        if self._data is None:
+            with open(self.path, "rb") as f:
+                self._data = f.read()
+        return self._data
+
+    @property
+    def image(self):
+        if self._image is None:
+            from PIL import Image  # Imported on first decode, most records never need it
+            # Decoding straight from the file lets Pillow read (or memory-map) it in pieces
+            image = Image.open(self.path if self._data is None else BytesIO(self._data))
+            image.load()
+            self._image = image
+        return self._image
+
+    def write_to(self, path):
+        if self._data is None:
+            shutil.copyfile(self.path, path)
+        else:
+            with open(path, "wb") as f:
+                f.write(self._data)
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES.get(self.format, "application/octet-stream")
+
+    @property
+    def extension(self):
+        return EXTENSIONS.get(self.format, self.format.lower())
+
+    def data_url(self):
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode()}"
@@ -1,234 +1,101 @@
 import streamlit as st
-import requests
 import time
-from PIL import Image
-from io import BytesIO
 import logging
 import os
-import random
-from storage import save_history, load_history
-import base64
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
+import mimetypes
+from core import IMAGE_SIZES, MAX_NUM_IMAGES, stream_prompt, generate_variants, sweep_variants, upscale_image, save_images, discard_images
+from cache import generation_cache
+import encoding
+from metrics import start_metrics_server
+import ratelimit
+from jobs import DONE, FAILED, JobLimitError, job_queue
+from storage import history_writer, load_history, load_history_image, get_thumbnail, migrate_json_history
+import uuid
 
 # Set up logging
-logging.basicConfig(level=logging.ERROR)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
-# Constants
-BASE_URL = "https://api.aimlapi.com"
-IMAGE_GEN_URL = f"{BASE_URL}/images/generations"
-CHAT_URL = f"{BASE_URL}/chat/completions"
-IMAGE_MODEL = "flux-pro"
-CHAT_MODEL = "gpt-4o-2024-08-06"
-
-# API key
-API_KEY = os.getenv("API_KEY")
-
-IMAGE_SIZES = {
-    "square_hd": "Square HD",
-    "square": "Square",
-    "portrait_4_3": "Portrait 4:3",
-    "portrait_16_9": "Portrait 16:9",
-    "landscape_4_3": "Landscape 4:3",
-    "landscape_16_9": "Landscape 16:9"
-}
-
-def generate_prompt(user_input):
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    system_prompt = """Objective:
-This system will generate creative and detailed AI image prompts based on a user's description, emulating the distinctive style and structure observed in a comprehensive set of user-provided example prompts. The system will aim for accuracy, detail, and flexibility, ensuring the generated prompts are suitable for use with AI image generators like Midjourney, Stable Diffusion, and DALL-E.
-
-Core Principles:
-
-    Faithful Style Replication: The system will prioritize mirroring the nuanced style of the user's examples. This includes:
-
-        Concise Subject Introduction: Starting with a clear and brief subject or scene description.
-
-        Varied Style Keywords: Incorporating a diverse range of keywords related to art style, photography techniques, and desired aesthetics (e.g., "cinematic," "Pixar-style," "photorealistic," "minimalist," "surrealism").
-
-        Artistic References: Integrating specific artists, art movements, or pop culture references to guide the AI's stylistic interpretation.
-
-        Optional Technical Details: Including optional yet specific details about:
-
-            Camera and Lens: "Canon EOS R5," "Nikon D850 with a macro lens," "35mm lens at f/8."
-
-            Film Stock: "Kodak film," "Fujifilm Provia."
-
-            Post-Processing: "Film grain," "lens aberration," "color negative," "bokeh."
-
-        AI Model Parameters: Adding relevant parameters like aspect ratio ("--ar 16:9"), stylization ("--stylize 750"), chaos ("--s 750"), or version ("--v 6.0").
-
-        Negative Prompts: Employing negative prompts to exclude undesired elements.
-
-        Emphasis Techniques: Utilizing parentheses, brackets, or capitalization to highlight key elements within the prompt.
-
-    User-Centric Design:
-
-        Clarity and Specificity: The generated prompts should be clear, specific, and easily understood by the AI.
-
-        Open-Ended Options: Allow for open-ended descriptions when users seek more creative freedom.
-
-        Iterative Refinement: Support modifications and adjustments based on user feedback to facilitate an iterative creation process.
-
-    Comprehensive Prompt Structure:
-
-        Subject: Clearly define the primary subject(s) of the image.
-
-        Action/Pose: Describe actions or poses the subject(s) might be performing.
-
-        Environment/Background: Establish the scene's setting, including background elements.
-
-        Style/Art Medium: Specify the desired artistic style or medium (photography, illustration, painting, pixel art, etc.).
-
-        Lighting: Detail the lighting conditions (soft light, dramatic light, natural light, studio lighting, etc.).
-
-        Color Palette: Suggest a specific color palette or individual colors.
-
-        Composition: Indicate the preferred composition (close-up, wide-angle, symmetrical, minimalist, etc.).
-
-        Details/Texture: Include descriptions of textures, patterns, and specific features.
-
-        Mood/Atmosphere: Optionally evoke a mood or atmosphere to guide the AI's interpretation (melancholic, mysterious, serene, etc.).
-
-Example Interaction:
-
-User Input: "A portrait of a futuristic robot, with neon lights reflecting on its metallic surface, in a cyberpunk city."
-
-System Output:
-"Portrait of a futuristic robot, neon lights reflecting on its metallic surface, standing in a cyberpunk city, detailed circuitry, glowing eyes, (gritty), (cyberpunk aesthetic), in the style of Syd Mead, cinematic lighting, 85mm lens, film grain, --ar 3:2 --v 6.0 --style raw"
-
-Generate a prompt based on the user's input."""
-
-    payload = {
-        "model": CHAT_MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_input}
-        ],
-        "max_tokens": 150,
-        "temperature": 1
-    }
-    
-    try:
-        response = requests.post(CHAT_URL, json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()['choices'][0]['message']['content']
-    except requests.exceptions.RequestException as e:
-        error_message = f"Error generating prompt: {str(e)}"
-        if hasattr(e.response, 'text'):
-            error_message += f"\nResponse content: {e.response.text}"
-        logger.error(error_message)
-        print(error_message)  # Print detailed error to terminal
-        return "Failed to generate prompt. Please try again later."
-
-def upscale_image(image, version="v1.4", scale_factor=2):
-    API_URLS = [
-        "https://algoworks-image-face-upscale-restoration-gfpgan-pub.hf.space/api/predict",
-        "https://nightfury-image-face-upscale-restoration-gfpgan.hf.space/api/predict"
-    ]
-    
-    # Convert PIL Image to base64
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    
-    # Prepare the payload
-    payload = {
-        "data": [
-            f"data:image/png;base64,{img_str}",
-            version,
-            scale_factor
-        ]
-    }
-    
-    for API_URL in API_URLS:
-        try:
-            response = requests.post(API_URL, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            
-            # The API returns a list of results, we're interested in the first item
-            upscaled_image_data = result['data'][0].split(',')[1]
-            upscaled_image = Image.open(BytesIO(base64.b64decode(upscaled_image_data)))
-            return upscaled_image
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error upscaling image with {API_URL}: {str(e)}")
-            if API_URL == API_URLS[-1]:
-                return None  # If this is the last API, return None
-            # If it's not the last API, continue to the next one
-    
-    return None  # This line should never be reached, but it's here for completeness
-
-def generate_image(prompt, size, steps, guidance, num_images, seed, safety_tolerance, sync_mode, upscale=False):
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": IMAGE_MODEL,
-        "prompt": prompt,
-        "image_size": size,
-        "num_inference_steps": steps,
-        "guidance_scale": guidance,
-        "num_images": num_images,
-        "safety_tolerance": safety_tolerance,
-        "sync_mode": sync_mode
-    }
-    if seed is not None:
-        payload["seed"] = seed
-
+start_metrics_server()
+
+# Seconds between status checks of background generation jobs
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+STEPS_RANGE = (1, 100)
+GUIDANCE_RANGE = (0.0, 20.0)
+
+GRID_COLUMNS = 4
+MAX_SWEEP_VALUES = 8
+# Sweepable parameter -> (variant key, type, allowed range or None)
+SWEEP_PARAMETERS = {"Seed": ("seed", int, None), "Guidance": ("guidance", float, GUIDANCE_RANGE), "Steps": ("steps", int, STEPS_RANGE)}
+
+def variant_label(variant):
+    return f"Seed {variant['seed']}, guidance {variant['guidance']}, {variant['steps']} steps"
+
+def run_generation_job(prompt, size, variants, num_images, upscale, progress=None, cancelled=lambda: False):
+    # Runs on a job worker thread, so it must not call any st.* functions.
+    # Arriving images are put in `progress` for the polling fragment to show.
+    # A cancelled or failed job saves nothing and deletes its downloads
+    safety_tolerance = "6"
+    sync_mode = False  # Jobs are polled, so the API does not need to hold the request open
+
+    def on_image(variant_index, image_index, image):
+        image.data  # Read into memory before save_images moves the downloaded file
+        progress[(variant_index, image_index)] = image
+
+    results = generate_variants(
+        prompt,
+        size,
+        variants,
+        num_images,
+        safety_tolerance,
+        sync_mode,
+        upscale,
+        on_image if progress is not None else None
+    )
+    images, labels, errors = [], [], []
+    for variant, (variant_images, error) in zip(variants, results):
+        images += variant_images
+        labels += [variant_label(variant) if len(variants) > 1 else ""] * len(variant_images)
+        if error:
+            errors.append(error)
+
+    history_items = []
+    downloads = []
     try:
-        response = requests.post(IMAGE_GEN_URL, json=payload, headers=headers)
-        response.raise_for_status()
-        images = []
-        image_urls = []
-        for image_data in response.json()['images']:
-            image_url = image_data['url']
-            image_urls.append(image_url)
-            image_response = requests.get(image_url)
-            image_response.raise_for_status()
-            image = Image.open(BytesIO(image_response.content))
-                
-            if upscale:
-                upscaled_image = upscale_image(image)
-                if upscaled_image:
-                    images.append(upscaled_image)
-                else:
-                    images.append(image)  # Fallback to original if upscaling fails
-            else:
-                images.append(image)
-        
-        return images, image_urls, None
-    except requests.exceptions.RequestException as e:
-        error_message = f"Error generating image: {str(e)}"
-        if hasattr(e.response, 'text'):
-            error_message += f"\nResponse content: {e.response.text}"
-        logger.error(error_message)
-        print(error_message)  # Print detailed error to terminal
-        return None, None, "Failed to generate image. Please check the terminal for detailed error messages."
-
-def log_generated_image(image_path, prompt):
-    logger.info(f"Generated Image: {image_path}")
-    logger.info(f"Prompt: {prompt}")
-
-def save_images(images, prompt):
-    output_folder = "generated_images"
-    os.makedirs(output_folder, exist_ok=True)
-    saved_paths = []
+        if cancelled():
+            discard_images(images)
+            return [], labels, None, history_items, downloads
+        if images:
+            # Download copies are encoded (per DOWNLOAD_ENCODING) while the images are saved
+            download_futures = [encoding.encode_async(image, "download") for image in images]
+            save_images(images, prompt)  # Automatically save the whole grid as one batch
+            if cancelled():
+                return [], labels, None, history_items, downloads
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+            history_items = [history_writer.add(image, prompt, timestamp) for image in images]
+            downloads = [future.result() for future in download_futures]
+    except Exception:
+        discard_images(images)  # Only files save_images has not moved yet
+        raise
+    return images, labels, "\n".join(errors) or None, history_items, downloads
+
+def parse_sweep_values(text, cast, bounds=None):
+    values = [cast(value) for value in text.replace(",", " ").split()]
+    if len(values) > MAX_SWEEP_VALUES:
+        raise ValueError(f"At most {MAX_SWEEP_VALUES} sweep values are supported")
+    if bounds is not None:
+        low, high = bounds
+        outside = [value for value in values if not low <= value <= high]
+        if outside:
+            raise ValueError(f"{', '.join(map(str, outside))} outside the allowed range {low} to {high}")
+    return values
+
+def show_image_grid(images, labels=None):
+    columns = st.columns(min(len(images), GRID_COLUMNS))
     for i, image in enumerate(images):
-        timestamp = int(time.time())
-        filename = f"generated_image_{timestamp}_{i+1}.png"
-        filepath = os.path.join(output_folder, filename)
-        image.save(filepath)
-        saved_paths.append(filepath)
-        log_generated_image(filepath, prompt)
-    return saved_paths
+        with columns[i % len(columns)]:
+            st.image(image.data, caption=labels[i] if labels else None, use_column_width=True)
 
 st.set_page_config(page_title="AI Image Alchemist", layout="centered", initial_sidebar_state="expanded")
 
@@ -322,16 +189,30 @@ st.markdown("""
 
 st.title("🎨 AI Image Alchemist")
 
+cache_stats = generation_cache.stats()
+st.sidebar.caption(f"Generation cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+
+# Identifies this browser session to the shared rate limits and job queue
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 st.header("📝 Generate Prompt")
 user_input = st.text_area("Enter your idea for an image:", key="user_input")
-if st.button("Generate Prompt", key="generate_prompt_button") or (user_input and user_input.endswith('\n')):
-    with st.spinner("Generating prompt..."):
-        generated_prompt = generate_prompt(user_input)
-        if "Failed to generate prompt" in generated_prompt:
-            st.error(generated_prompt)
-        else:
-            st.session_state.generated_prompt = generated_prompt
-            st.success("Prompt generated successfully!")
+fresh_prompt = st.checkbox("Fresh variation", value=False, help="Ask the model again instead of reusing the prompt generated for the same idea")
+prompt_clicked = st.button("Generate Prompt", key="generate_prompt_button")
+if prompt_clicked or (user_input and user_input.endswith('\n')):
+    # Tokens are shown as they arrive, then the full prompt moves into the text area below
+    streaming_output = st.empty()
+    # The generator runs while it is consumed, so the session applies to its request
+    with streaming_output, ratelimit.session(st.session_state.session_id):
+        # The newline trigger fires again on every rerun, so only a click asks for a fresh prompt
+        generated_prompt = st.write_stream(stream_prompt(user_input, fresh=fresh_prompt and prompt_clicked))
+    streaming_output.empty()
+    if "Failed to generate prompt" in generated_prompt:
+        st.error(generated_prompt)
+    else:
+        st.session_state.generated_prompt = generated_prompt
+        st.success("Prompt generated successfully!")
 
 st.header("🖼️ Generate Image")
 image_prompt = st.text_area("Enter the prompt for image generation:", value=st.session_state.get('generated_prompt', ''), key="image_prompt")
@@ -340,107 +221,172 @@ col1, col2, col3, col4 = st.columns(4)
 with col1:
     st.session_state.size = st.selectbox("Image Size", list(IMAGE_SIZES.keys()), format_func=lambda x: IMAGE_SIZES[x])
 with col2:
-    st.session_state.steps = st.slider("Inference Steps", 1, 100, 28)
+    st.session_state.steps = st.slider("Inference Steps", *STEPS_RANGE, 28)
 with col3:
-    st.session_state.guidance = st.slider("Guidance Scale", 0.0, 20.0, 3.5, 0.1)
+    st.session_state.guidance = st.slider("Guidance Scale", *GUIDANCE_RANGE, 3.5, 0.1)
 with col4:
     st.session_state.upscale = st.checkbox("Upscale Image", value=False)
 
+with st.expander("Grid mode"):
+    num_images = st.slider("Images per request", 1, MAX_NUM_IMAGES, 1, help="Images the API returns for one request")
+    sweep = st.selectbox("Sweep", ["None"] + list(SWEEP_PARAMETERS), help="Send one request per value, all at the same time")
+    sweep_text = st.text_input("Sweep values", placeholder="e.g. 1, 2, 3, 4", disabled=sweep == "None")
+
+if 'pending_jobs' not in st.session_state:
+    st.session_state.pending_jobs = []
+if 'job_progress' not in st.session_state:
+    st.session_state.job_progress = {}
+if 'job_prompts' not in st.session_state:
+    st.session_state.job_prompts = {}
+
 if st.button("Generate Image", key="generate_image_button") or (image_prompt and image_prompt.endswith('\n')):
     if image_prompt:
-        with st.spinner("Generating image..."):
-            try:
-                safety_tolerance = "6"
-                num_images = 1  # Set in backend
-                seed = 0  # Set in backend
-                sync_mode = True  # Set in backend
-                images, image_urls, error = generate_image(
-                    image_prompt, 
-                    st.session_state.size,
-                    st.session_state.steps,
-                    st.session_state.guidance,
-                    num_images,
-                    seed,
-                    safety_tolerance,
-                    sync_mode,
-                    st.session_state.upscale
-                )
-                if images:
-                    st.session_state.generated_images = images
-                    st.success("Image generated successfully! Scroll down to view.")
-                    saved_paths = save_images(images, image_prompt)  # Automatically save images
-                    
-                    if 'image_history' not in st.session_state:
-                        st.session_state.image_history = load_history()
-                    
-                    history_item = {
-                        'image': images[0],
-                        'prompt': image_prompt,
-                        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    st.session_state.image_history.insert(0, history_item)
-                    if len(st.session_state.image_history) > 5:
-                        st.session_state.image_history.pop()
-                    save_history(st.session_state.image_history)
-                elif error:
-                    st.error(f"Failed to generate image: {error}")
-                    print(f"Error details: {error}")  # Print error details to terminal
-                else:
-                    st.warning("No image was generated. Please try again.")
-            except Exception as e:
-                st.error("An unexpected error occurred. Please try again later.")
-                print(f"Unexpected error: {str(e)}")  # Print unexpected error details to terminal
-                logger.exception("Error in image generation")
+        base = {"seed": 0, "guidance": st.session_state.guidance, "steps": st.session_state.steps}
+        try:
+            parameter, cast, bounds = SWEEP_PARAMETERS.get(sweep, (None, None, None))
+            values = parse_sweep_values(sweep_text, cast, bounds) if parameter else []
+            variants = sweep_variants(base, parameter, values)
+            progress = {}
+            job_id = job_queue.submit(
+                st.session_state.session_id,
+                run_generation_job,
+                image_prompt,
+                st.session_state.size,
+                variants,
+                num_images,
+                st.session_state.upscale,
+                progress
+            )
+            st.session_state.pending_jobs.append(job_id)
+            st.session_state.job_progress[job_id] = progress
+            st.session_state.job_prompts[job_id] = image_prompt
+        except ValueError as e:
+            st.warning(f"Invalid sweep values: {str(e)}")
+        except JobLimitError as e:
+            st.warning(str(e))
     else:
         st.warning("Please enter a prompt for image generation.")
 
+def handle_finished_job(job, prompt):
+    if job.status == FAILED:
+        st.session_state.job_messages.append(("error", "An unexpected error occurred. Please try again later."))
+        logger.error(f"Unexpected error: {job.error}")
+        return
+    if job.status != DONE:
+        return
+
+    images, labels, error, history_items, downloads = job.result
+    if images:
+        st.session_state.generated_images = images
+        st.session_state.generated_labels = labels
+        st.session_state.download_images = downloads
+        st.session_state.generated_images_prompt = prompt
+        st.session_state.job_messages.append(("success", "Image generated successfully! Scroll down to view."))
+        if error:
+            st.session_state.job_messages.append(("warning", error))
+        if 'image_history' not in st.session_state:
+            migrate_json_history()
+            st.session_state.image_history = load_history()
+        st.session_state.image_history[:0] = reversed(history_items)
+    elif error:
+        st.session_state.job_messages.append(("error", f"Failed to generate image: {error}"))
+        logger.error(f"Error details: {error}")
+    else:
+        st.session_state.job_messages.append(("warning", "No image was generated. Please try again."))
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_pending_jobs():
+    finished = False
+    for job_id in list(st.session_state.pending_jobs):
+        job = job_queue.get(job_id)
+        if job is None or not job.active:
+            st.session_state.pending_jobs.remove(job_id)
+            st.session_state.job_progress.pop(job_id, None)
+            prompt = st.session_state.job_prompts.pop(job_id, "")
+            if job is not None:
+                handle_finished_job(job, prompt)
+                job_queue.forget(job_id)
+            finished = True
+            continue
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.info(f"Generating image... ({job.status})")
+        with col2:
+            if st.button("Cancel", key=f"cancel_job_{job_id}"):
+                job_queue.cancel(job_id)
+                st.session_state.job_messages.append(("warning", "Image generation cancelled."))
+                finished = True
+        # Images are shown as they arrive; copying the dict is safe while the job adds to it
+        arrived = dict(st.session_state.job_progress.get(job_id, {}))
+        if arrived:
+            show_image_grid([arrived[key] for key in sorted(arrived)])
+    if finished:
+        st.rerun()
+
+if 'job_messages' not in st.session_state:
+    st.session_state.job_messages = []
+for level, message in st.session_state.job_messages:
+    getattr(st, level)(message)
+st.session_state.job_messages = []
+
+if st.session_state.pending_jobs:
+    show_pending_jobs()
+
 st.header("Generated Image")
 if 'generated_images' in st.session_state and st.session_state.generated_images:
-    image = st.session_state.generated_images[0]
-    
-    image_key = f"image_{int(time.time())}"
-    
-    st.image(image, caption="Generated Image", use_column_width=True, output_format="PNG")
-    
-    # Add download button
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    href = f'<a href="data:file/png;base64,{img_str}" download="generated_image.png">Download Image</a>'
-    st.markdown(href, unsafe_allow_html=True)
-    
-    st.markdown(f"""
-    <div id="modal_{image_key}" class="modal">
-        <span class="close" onclick="document.getElementById('modal_{image_key}').style.display='none'">&times;</span>
-        <img class="modal-content" id="img_{image_key}">
-    </div>
-    <script>
-    const img = document.querySelector('img[src$=".png"]');
-    const modal = document.getElementById('modal_{image_key}');
-    const modalImg = document.getElementById('img_{image_key}');
-    img.onclick = function(){{
-        modal.style.display = "block";
-        modalImg.src = this.src;
-    }}
-    </script>
-    """, unsafe_allow_html=True)
+    images = st.session_state.generated_images
+    labels = st.session_state.get('generated_labels') or [""] * len(images)
+    downloads = st.session_state.get('download_images') or images
+
+    if len(images) > 1:
+        show_image_grid(images, labels)
+        links = " · ".join(
+            f'<a href="{download.data_url()}" download="generated_image_{i + 1}.{download.extension}">Image {i + 1}</a>'
+            for i, download in enumerate(downloads)
+        )
+        st.markdown(f"Download: {links}", unsafe_allow_html=True)
+        selected = st.selectbox("Image to upscale", range(len(images)), format_func=lambda i: f"Image {i + 1}" + (f" ({labels[i]})" if labels[i] else ""))
+        image = images[selected]
+    else:
+        image = images[0]
+
+        image_key = f"image_{int(time.time())}"
+
+        st.image(image.data, caption="Generated Image", use_column_width=True)
+
+        # Add download button
+        href = f'<a href="{downloads[0].data_url()}" download="generated_image.{downloads[0].extension}">Download Image</a>'
+        st.markdown(href, unsafe_allow_html=True)
+
+        st.markdown(f"""
+        <div id="modal_{image_key}" class="modal">
+            <span class="close" onclick="document.getElementById('modal_{image_key}').style.display='none'">&times;</span>
+            <img class="modal-content" id="img_{image_key}">
+        </div>
+        <script>
+        const img = document.querySelector('img[src$=".{image.extension}"]');
+        const modal = document.getElementById('modal_{image_key}');
+        const modalImg = document.getElementById('img_{image_key}');
+        img.onclick = function(){{
+            modal.style.display = "block";
+            modalImg.src = this.src;
+        }}
+        </script>
+        """, unsafe_allow_html=True)
     
     if st.button("Upscale Image"):
         with st.spinner("Upscaling image..."):
-            upscaled_image = upscale_image(image)
+            with ratelimit.session(st.session_state.session_id):
+                upscaled_image = upscale_image(image)
             if upscaled_image:
-                output_folder = "generated_images"
-                os.makedirs(output_folder, exist_ok=True)
-                timestamp = int(time.time())
-                filename = f"upscaled_image_{timestamp}.png"
-                filepath = os.path.join(output_folder, filename)
-                upscaled_image.save(filepath)
-                
-                with open(filepath, "rb") as file:
-                    b64 = base64.b64encode(file.read()).decode()
-                    href = f'<a href="data:image/png;base64,{b64}" download="{filename}"></a>'
-                    st.markdown(href, unsafe_allow_html=True)
-                    st.markdown(f'<script>document.querySelector("a[download=\'{filename}\']").click();</script>', unsafe_allow_html=True)
+                # The download copy is encoded while the upscaled image is archived and indexed
+                download_future = encoding.encode_async(upscaled_image, "download")
+                filepath, = save_images([upscaled_image], st.session_state.get('generated_images_prompt', ''), prefix="upscaled_image")
+                download = download_future.result()
+                filename = f"{os.path.splitext(os.path.basename(filepath))[0]}.{download.extension}"
+                href = f'<a href="{download.data_url()}" download="{filename}"></a>'
+                st.markdown(href, unsafe_allow_html=True)
+                st.markdown(f'<script>document.querySelector("a[download=\'{filename}\']").click();</script>', unsafe_allow_html=True)
                 
                 st.success("Image upscaled and downloaded successfully!")
             else:
@@ -449,13 +395,15 @@ if 'generated_images' in st.session_state and st.session_state.generated_images:
 st.header("🕰️ Image History")
 
 if 'image_history' not in st.session_state:
+    migrate_json_history()
     st.session_state.image_history = load_history()
 
 for i, item in enumerate(st.session_state.image_history):
     col1, col2 = st.columns([1, 3])
     with col1:
-        if item['image'] is not None:
-            st.image(item['image'], caption=f"Generated on {item['timestamp']}", use_column_width=True)
+        thumbnail = get_thumbnail(item)
+        if thumbnail is not None:
+            st.image(thumbnail, caption=f"Generated on {item['timestamp']}", use_column_width=True)
         else:
             st.write("Image not available")
     with col2:
@@ -463,6 +411,23 @@ for i, item in enumerate(st.session_state.image_history):
         if st.button("Reuse Prompt", key=f"reuse_prompt_{i}"):
             st.session_state.generated_prompt = item['prompt']
             st.rerun()
+        # Items still being written in the background have no id yet
+        if thumbnail is not None and item['id'] is not None and st.button("View Full Image", key=f"view_history_{i}"):
+            st.session_state.history_view = item['id']
+    # Full resolution is only loaded when explicitly requested
+    if item['id'] is not None and st.session_state.get('history_view') == item['id']:
+        full_image = load_history_image(item['id'])
+        if full_image is not None:
+            st.image(full_image, caption=item['prompt'], use_column_width=True)
+            with open(item['image_path'], "rb") as file:
+                st.download_button("Download Image", file.read(), file_name=os.path.basename(item['image_path']), mime=mimetypes.guess_type(item['image_path'])[0], key=f"download_history_{i}")
+            if st.button("Close", key=f"close_history_{i}"):
+                st.session_state.history_view = None
+                st.rerun()
+
+if st.session_state.image_history and st.button("Load More History", key="load_more_history"):
+    st.session_state.image_history += load_history(before=st.session_state.image_history[-1])
+    st.rerun()
 
 st.markdown("---")
 st.markdown("<p style='text-align: center;'>© 2023 AI Image Alchemist. All rights reserved.</p>", unsafe_allow_html=True)
\ No newline at end of file
@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import ratelimit
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_PER_USER_LIMIT = int(os.getenv("JOB_PER_USER_LIMIT", "3"))
+# Finished jobs are kept this many seconds for the UI to pick up their result
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+class JobLimitError(Exception):
+    pass
+
+class Job:
+    def __init__(self, user_id):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.future = None
+        self.cancel_requested = threading.Event()
+        self.forgotten = False
+
+    @property
+    def active(self):
+        return self.status not in FINISHED_STATUSES
+
+    @property
+    def occupying_worker(self):
+        # A job cancelled while running keeps its worker until the function returns
+        return self.active or (self.future is not None and not self.future.done())
+
+class JobQueue:
+    """Runs submitted callables on a shared worker pool.
+
+    Each user may have at most `per_user_limit` queued or running jobs.
+    Callers poll `get(job_id)` for the status and result. The callable gets
+    a `cancelled` keyword argument, a function that returns True once the
+    job has been cancelled, and should check it before any side effects.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, per_user_limit=JOB_PER_USER_LIMIT, ttl=JOB_TTL):
+        self.per_user_limit = per_user_limit
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id, fn, *args, **kwargs):
+        with self._lock:
+            self._prune()
+            active = sum(1 for job in self._jobs.values() if job.user_id == user_id and job.occupying_worker)
+            if active >= self.per_user_limit:
+                raise JobLimitError(f"You already have {active} jobs in progress. Please wait for one to finish.")
+            job = Job(user_id)
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job, fn, args, kwargs):
+        with self._lock:
+            if job.status == CANCELLED:
+                return
+            job.status = RUNNING
+        try:
+            with ratelimit.session(job.user_id):
+                result = fn(*args, cancelled=job.cancel_requested.is_set, **kwargs)
+        except Exception as e:
+            logger.exception(f"Job {job.id} failed")
+            with self._lock:
+                if job.status != CANCELLED:
+                    job.status = FAILED
+                    job.error = str(e)
+                job.finished = time.time()
+            return
+        with self._lock:
+            # A job cancelled while running finishes in the background but its result is dropped
+            if job.status != CANCELLED:
+                job.status = DONE
+                job.result = result
+            job.finished = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not job.active:
+                return False
+            job.status = CANCELLED
+            job.cancel_requested.set()
+            job.future.cancel()
+            job.finished = time.time()
+            return True
+
+    def forget(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if job.occupying_worker:
+                # Still counted against the user's limit until it stops, then pruned
+                job.forgotten = True
+            else:
+                del self._jobs[job_id]
+
+    def _prune(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if not job.occupying_worker and (job.forgotten or job.finished is not None and now - job.finished > self.ttl)]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+job_queue = JobQueue()
@@ -0,0 +1,216 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Local Prometheus endpoint; set METRICS_PORT=0 to disable it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Optional JSONL file receiving one line per finished span
+TRACE_FILE = os.getenv("TRACE_FILE")
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _get_or_create(cls, name, help, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = cls(name, help, **kwargs)
+            _registry[name] = metric
+        return metric
+
+def counter(name, help):
+    return _get_or_create(Counter, name, help)
+
+def gauge(name, help):
+    return _get_or_create(Gauge, name, help)
+
+def histogram(name, help, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, help, buckets=buckets)
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+stage_seconds = histogram("imagen_stage_seconds", "Time spent in each pipeline stage")
+stage_total = counter("imagen_stage_total", "Pipeline stage executions")
+stage_failures = counter("imagen_stage_failures_total", "Pipeline stage executions that failed")
+stage_in_flight = gauge("imagen_stage_in_flight", "Pipeline stage executions currently running")
+
+_trace_lock = threading.Lock()
+_trace_file = None
+
+def write_trace(record):
+    global _trace_file
+    with _trace_lock:
+        if _trace_file is None:
+            _trace_file = open(TRACE_FILE, "a")
+        _trace_file.write(json.dumps(record) + "\n")
+        _trace_file.flush()
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.failed = False
+
+    def fail(self):
+        # For stages that report failure by return value instead of raising
+        self.failed = True
+
+@contextmanager
+def span(stage):
+    current = Span(stage)
+    stage_in_flight.inc(stage=stage)
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        current.failed = True
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_in_flight.dec(stage=stage)
+        stage_seconds.observe(duration, stage=stage)
+        stage_total.inc(stage=stage)
+        if current.failed:
+            stage_failures.inc(stage=stage)
+        if TRACE_FILE:
+            write_trace({
+                "stage": stage,
+                "start": start_time,
+                "duration": duration,
+                "ok": not current.failed,
+                "thread": threading.current_thread().name
+            })
+
+def timed(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    # Safe to call on every Streamlit rerun; only the first call starts a server
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            # http.server pulls in email and http.client, so import it only when serving
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path != "/metrics":
+                        self.send_response(404)
+                        self.end_headers()
+                        return
+                    body = render().encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            try:
+                _server = ThreadingHTTPServer((host, port), MetricsHandler)
+            except OSError as e:
+                logger.warning(f"Could not start metrics server on {host}:{port}: {str(e)}")
+                _server = False
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+            logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return _server or None
@@ -0,0 +1,222 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Requests per second and burst size allowed per upstream endpoint, shared by
+# every session of this process; a rate of 0 disables the limit
+RATE_LIMITS = {
+    "image": (float(os.getenv("IMAGE_RATE_LIMIT", "2")), int(os.getenv("IMAGE_RATE_BURST", "4"))),
+    "chat": (float(os.getenv("CHAT_RATE_LIMIT", "5")), int(os.getenv("CHAT_RATE_BURST", "10"))),
+    "upscale": (float(os.getenv("UPSCALE_RATE_LIMIT", "2")), int(os.getenv("UPSCALE_RATE_BURST", "4")))
+}
+
+rate_limit_wait_seconds = metrics.histogram("imagen_rate_limit_wait_seconds", "Time spent waiting for a rate limit token")
+rate_limit_waiting = metrics.gauge("imagen_rate_limit_waiting", "Requests currently waiting for a rate limit token")
+coalesced_requests = metrics.counter("imagen_coalesced_requests_total", "Requests that shared an identical in-flight call")
+
+_current_session = contextvars.ContextVar("rate_limit_session", default=None)
+
+@contextmanager
+def session(session_id):
+    # Requests made inside this block are queued fairly against other sessions
+    token = _current_session.set(session_id)
+    try:
+        yield
+    finally:
+        _current_session.reset(token)
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts of up to `burst`.
+
+    Callers that have to wait are queued per session and served round-robin,
+    so one session submitting many requests cannot starve the others.
+    """
+
+    def __init__(self, rate, burst=1, name=None):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.name = name
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # session -> deque of waiting tickets
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _grant(self, session_id):
+        queue = self._queues.pop(session_id)
+        queue.popleft()
+        if queue:
+            # The session goes to the back of the line for its next request
+            self._queues[session_id] = queue
+        self._tokens -= 1
+        self._cond.notify_all()
+
+    def acquire(self, session_id=None):
+        if not self.rate:
+            return 0.0
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            waiting = False
+            try:
+                while True:
+                    self._refill()
+                    head_session, head_queue = next(iter(self._queues.items()))
+                    if head_queue[0] is ticket and self._tokens >= 1:
+                        self._grant(head_session)
+                        break
+                    if not waiting:
+                        waiting = True
+                        rate_limit_waiting.inc(endpoint=self.name)
+                    self._cond.wait((1 - self._tokens) / self.rate if self._tokens < 1 else None)
+            finally:
+                if waiting:
+                    rate_limit_waiting.dec(endpoint=self.name)
+        waited = time.monotonic() - start
+        rate_limit_wait_seconds.observe(waited, endpoint=self.name)
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f}s for the {self.name} rate limit")
+        return waited
+
+limiters = {name: TokenBucket(rate, burst, name) for name, (rate, burst) in RATE_LIMITS.items()}
+
+def acquire(endpoint):
+    # Blocks until the endpoint's shared limit allows one more request
+    return limiters[endpoint].acquire(_current_session.get())
+
+class SingleFlight:
+    """Runs one call per key at a time.
+
+    Callers arriving while a call with the same key is running wait for it
+    and get its result instead of making their own. `share` converts the
+    result for those callers when they must not share the leader's objects.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, share=None, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                call.waiters = 0
+            else:
+                call.waiters += 1
+        if not leader:
+            coalesced_requests.inc(call=self.name)
+            return call.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.set_exception(e)
+            raise
+        with self._lock:
+            # No caller can join once the key is removed
+            del self._calls[key]
+            waiters = call.waiters
+        if waiters:
+            try:
+                call.set_result(share(result) if share else result)
+            except Exception as e:
+                call.set_exception(e)
+        return result
+
+class SharedStream:
+    # Chunks of one in-flight stream, kept for the callers that joined it
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.complete = False
+        self.cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self, complete):
+        with self.cond:
+            self.done = True
+            self.complete = complete
+            self.cond.notify_all()
+
+class StreamFlight:
+    """SingleFlight for generators.
+
+    Callers arriving while a stream with the same key is running get the
+    chunks produced so far and then each new one as the leader yields it.
+    If the leader stops early (its consumer went away or it raised), a
+    caller that has received nothing yet starts over, and one that has
+    received part of the stream gets `aborted` as its last chunk.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def stream(self, key, fn, *args, aborted=None, **kwargs):
+        with self._lock:
+            shared = self._streams.get(key)
+            leader = shared is None
+            if leader:
+                shared = self._streams[key] = SharedStream()
+        if leader:
+            yield from self._lead(key, shared, fn(*args, **kwargs))
+            return
+
+        coalesced_requests.inc(call=self.name)
+        received = 0
+        while True:
+            with shared.cond:
+                while received >= len(shared.chunks) and not shared.done:
+                    shared.cond.wait()
+                chunks = shared.chunks[received:]
+                done, complete = shared.done, shared.complete
+            for chunk in chunks:
+                yield chunk
+            received += len(chunks)
+            if done:
+                break
+        if complete:
+            return
+        if not received:
+            yield from self.stream(key, fn, *args, aborted=aborted, **kwargs)
+        elif aborted is not None:
+            yield aborted
+
+    def _lead(self, key, shared, chunks):
+        complete = False
+        try:
+            for chunk in chunks:
+                shared.publish(chunk)
+                yield chunk
+            complete = True
+        finally:
+            chunks.close()
+            with self._lock:
+                # No caller can join once the key is removed
+                del self._streams[key]
+            shared.finish(complete)
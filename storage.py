@@ -1,72 +1,368 @@
+import atexit
+import hashlib
+import io
 import json
 import os
-from PIL import Image
-import io
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 import base64
 import logging
+import encoding
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: rely on SQLite's own locking
+    fcntl = None
 
 # Set up logging
-logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
+# Legacy single-file history, only read by migrate_json_history
 HISTORY_FILE = "image_history.json"
 
-def image_to_base64(image):
-    if image is None:
+# Metadata rows live in SQLite, image blobs as files next to it
+HISTORY_DB = "image_history.db"
+HISTORY_IMAGES_DIR = "history_images"
+
+HISTORY_PAGE_SIZE = 20
+
+# New items are written in the background, in one transaction per batch, once
+# no item has been added for HISTORY_FLUSH_DELAY seconds or the batch is full
+HISTORY_FLUSH_DELAY = float(os.getenv("HISTORY_FLUSH_DELAY", "0.5"))
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "50"))
+# Serializes writers across processes (e.g. the app and batch.py)
+HISTORY_LOCK_FILE = f"{HISTORY_DB}.lock"
+
+# Small previews for the history panel, keyed by image content hash
+THUMBNAIL_DIR = "thumbnails"
+THUMBNAIL_SIZE = (256, 256)
+# Defaults to WEBP when Pillow supports it, else JPEG, see thumbnail_format()
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "").upper() or None
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+def connect():
+    conn = sqlite3.connect(HISTORY_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            image_path TEXT,
+            image_hash TEXT
+        )
+    """)
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(history)")]
+    if 'image_hash' not in columns:
+        conn.execute("ALTER TABLE history ADD COLUMN image_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp, id)")
+    return conn
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+# Without fcntl only threads of this process are serialized
+_history_thread_lock = threading.Lock()
+
+@contextmanager
+def history_lock():
+    if fcntl is None:
+        with _history_thread_lock:
+            yield
+        return
+    with open(HISTORY_LOCK_FILE, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_history_image(record, stored=None):
+    # Stored as received unless HISTORY_ENCODING is set, in which case `stored`
+    # is the re-encoded record; the hash is always that of the received image.
+    # Written to a temporary file first so a crash never leaves a truncated image behind
+    stored = stored or record
+    os.makedirs(HISTORY_IMAGES_DIR, exist_ok=True)
+    image_path = os.path.join(HISTORY_IMAGES_DIR, f"{uuid.uuid4().hex}.{stored.extension}")
+    tmp_path = f"{image_path}.tmp"
+    stored.write_to(tmp_path)
+    with open(tmp_path, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, image_path)
+    return image_path, record.sha256 or content_hash(record.data)
+
+@metrics.timed("history_save")
+def write_history_items(entries):
+    # entries are (record, item) pairs; each item dict is filled in with its id and paths
+    rows = []
+    # Encoded before taking the lock, other writers need not wait for it
+    encoded = encoding.encode_all([record for record, _ in entries], "history")
+    with history_lock():
+        for (record, item), stored in zip(entries, encoded):
+            image_path, image_hash = None, None
+            if record is not None:
+                image_path, image_hash = write_history_image(record, stored)
+            rows.append((item, image_path, image_hash))
+        with connect() as conn:
+            ids = [conn.execute(
+                "INSERT INTO history (prompt, timestamp, image_path, image_hash) VALUES (?, ?, ?, ?)",
+                (item['prompt'], item['timestamp'], image_path, image_hash)
+            ).lastrowid for item, image_path, image_hash in rows]
+        conn.close()
+    for (record, _), (item, image_path, image_hash), item_id in zip(entries, rows, ids):
+        if record is not None:
+            make_thumbnail(record.image, image_hash)
+        item.update({'id': item_id, 'image_path': image_path, 'image_hash': image_hash})
+
+def add_history_item(record, prompt, timestamp):
+    # Synchronous write, see history_writer for the non-blocking version
+    item = {'id': None, 'prompt': prompt, 'timestamp': timestamp, 'image_path': None, 'image_hash': None}
+    write_history_items([(record, item)])
+    return item
+
+class HistoryWriter:
+    """Writes history items on a background thread.
+
+    `add` returns the item right away, pointing at the image's current file
+    so it can be shown before it is stored. Once the batch is written the
+    same dict gets its id and history image path.
+    """
+
+    def __init__(self, flush_delay=HISTORY_FLUSH_DELAY, batch_size=HISTORY_BATCH_SIZE):
+        self.flush_delay = flush_delay
+        self.batch_size = batch_size
+        self._pending = []
+        self._writing = False
+        self._last_add = 0.0
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def add(self, record, prompt, timestamp):
+        item = {
+            'id': None,
+            'prompt': prompt,
+            'timestamp': timestamp,
+            'image_path': record.path if record is not None else None,
+            'image_hash': record.sha256 if record is not None else None
+        }
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("History writer is closed")
+            self._pending.append((record, item))
+            self._last_add = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return item
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # Debounce: wait for a quiet period unless the batch is full or we are closing
+                while len(self._pending) < self.batch_size and not self._closed:
+                    remaining = self._last_add + self.flush_delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                self._writing = True
+            try:
+                write_history_items(batch)
+            except Exception as e:
+                logger.error(f"Error saving {len(batch)} history items: {str(e)}")
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        # Waits until everything added so far is written
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._last_add = 0.0
+            self._cond.notify_all()
+            while self._pending or self._writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.flush()
+
+history_writer = HistoryWriter()
+atexit.register(history_writer.close)
+
+@metrics.timed("history_load")
+def load_history(limit=HISTORY_PAGE_SIZE, before=None):
+    # Newest first; pass the last item of a page as `before` to get the next one
+    query = "SELECT id, prompt, timestamp, image_path, image_hash FROM history"
+    params = []
+    if before is not None:
+        query += " WHERE (timestamp, id) < (?, ?)"
+        params += [before['timestamp'], before['id']]
+    query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit)
+
+    conn = connect()
+    try:
+        return [dict(row) for row in conn.execute(query, params)]
+    finally:
+        conn.close()
+
+@metrics.timed("history_load_image")
+def load_history_image(item_id):
+    conn = connect()
+    try:
+        row = conn.execute("SELECT image_path FROM history WHERE id = ?", (item_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None or row['image_path'] is None:
+        return None
+    try:
+        from PIL import Image
+        return Image.open(row['image_path'])
+    except Exception as e:
+        logger.error(f"Error loading history image {item_id}: {str(e)}")
         return None
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode()
 
-def base64_to_image(base64_string):
-    if base64_string is None:
+def thumbnail_format():
+    # Resolved on first use so that importing storage does not load Pillow
+    global THUMBNAIL_FORMAT
+    if THUMBNAIL_FORMAT is None:
+        from PIL import features
+        THUMBNAIL_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+    return THUMBNAIL_FORMAT
+
+def thumbnail_path(image_hash):
+    format = thumbnail_format()
+    extension = "jpg" if format == "JPEG" else format.lower()
+    return os.path.join(THUMBNAIL_DIR, f"{image_hash}.{extension}")
+
+def make_thumbnail(image, image_hash):
+    path = thumbnail_path(image_hash)
+    if os.path.exists(path):
+        return path
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    format = thumbnail_format()
+    if format == "JPEG" and thumbnail.mode not in ("RGB", "L"):
+        thumbnail = thumbnail.convert("RGB")
+
+    os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    thumbnail.save(tmp_path, format=format, quality=THUMBNAIL_QUALITY)
+    os.replace(tmp_path, path)
+    evict_thumbnails()
+    return path
+
+def evict_thumbnails(max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+    # Least recently used first: get_thumbnail touches the mtime on every hit
+    entries = []
+    total = 0
+    for entry in os.scandir(THUMBNAIL_DIR):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        if total <= max_bytes:
+            break
+
+def get_thumbnail(item):
+    # Returns the path of a cached thumbnail, regenerating it if evicted
+    if item.get('image_path') is None:
         return None
-    image_data = base64.b64decode(base64_string)
-    return Image.open(io.BytesIO(image_data))
-
-def save_history(history):
-    serialized_history = []
-    for item in history:
-        serialized_item = item.copy()
-        if 'image' in item and item['image'] is not None:
-            serialized_item['image'] = image_to_base64(item['image'])
-        else:
-            serialized_item['image'] = None
-        serialized_history.append(serialized_item)
-    
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(serialized_history, f)
-
-def load_history():
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    
-    with open(HISTORY_FILE, 'r') as f:
+
+    image_hash = item.get('image_hash')
+    if image_hash is not None:
+        path = thumbnail_path(image_hash)
+        try:
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+    try:
+        with open(item['image_path'], 'rb') as f:
+            image_data = f.read()
+        if image_hash is None:
+            image_hash = content_hash(image_data)
+            with connect() as conn:
+                conn.execute("UPDATE history SET image_hash = ? WHERE id = ?", (image_hash, item['id']))
+            conn.close()
+            item['image_hash'] = image_hash
+        from PIL import Image
+        return make_thumbnail(Image.open(io.BytesIO(image_data)), image_hash)
+    except Exception as e:
+        logger.error(f"Error creating thumbnail for history item {item['id']}: {str(e)}")
+        return None
+
+def migrate_json_history(json_path=HISTORY_FILE):
+    if not os.path.exists(json_path):
+        return 0
+    # Sessions starting together may all get here; only the first one migrates
+    with history_lock():
+        if not os.path.exists(json_path):
+            return 0
+        return migrate_json_file(json_path)
+
+def migrate_json_file(json_path):
+    with open(json_path, 'r') as f:
         serialized_history = json.load(f)
-    
-    history = []
-    for item in serialized_history:
-        deserialized_item = item.copy()
-        if 'image' in item and item['image'] is not None:
+
+    # The JSON file is newest first; insert oldest first so ids follow time
+    rows = []
+    os.makedirs(HISTORY_IMAGES_DIR, exist_ok=True)
+    for item in reversed(serialized_history):
+        image_path, image_hash = None, None
+        if item.get('image') is not None:
             try:
-                deserialized_item['image'] = base64_to_image(item['image'])
+                image_data = base64.b64decode(item['image'])
+                image_path = os.path.join(HISTORY_IMAGES_DIR, f"{uuid.uuid4().hex}.png")
+                with open(image_path, 'wb') as f:
+                    f.write(image_data)
+                image_hash = content_hash(image_data)
             except Exception as e:
-                logger.error(f"Error deserializing image: {str(e)}")
-                deserialized_item['image'] = None
+                logger.error(f"Error migrating history image: {str(e)}")
+                image_path, image_hash = None, None
         else:
             logger.warning("Image data missing in history item")
-            deserialized_item['image'] = None
-        history.append(deserialized_item)
-    
-    return history
-
-# Add this new function to save all history items
-def save_all_history(history):
-    serialized_history = []
-    for item in history:
-        serialized_item = item.copy()
-        serialized_item['image'] = image_to_base64(item['image'])
-        serialized_history.append(serialized_item)
-    
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(serialized_history, f)
\ No newline at end of file
+        # Thumbnails for migrated items are created on first render
+        rows.append((item.get('prompt', ''), item.get('timestamp', ''), image_path, image_hash))
+
+    with connect() as conn:
+        conn.executemany("INSERT INTO history (prompt, timestamp, image_path, image_hash) VALUES (?, ?, ?, ?)", rows)
+    conn.close()
+
+    os.replace(json_path, f"{json_path}.migrated")
+    logger.warning(f"Migrated {len(rows)} history items from {json_path} to {HISTORY_DB}")
+    return len(rows)
+
+if __name__ == "__main__":
+    print(f"Migrated {migrate_json_history()} history items")
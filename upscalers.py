@@ -0,0 +1,369 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import http_client
+from image_record import ImageRecord
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+UPSCALE_API_URLS = os.getenv("UPSCALE_API_URLS", ",".join([
+    "https://algoworks-image-face-upscale-restoration-gfpgan-pub.hf.space/api/predict",
+    "https://nightfury-image-face-upscale-restoration-gfpgan.hf.space/api/predict"
+])).split(",")
+
+# Weight of the newest sample in the latency and error-rate averages
+EWMA_ALPHA = float(os.getenv("UPSCALER_EWMA_ALPHA", "0.2"))
+LATENCY_WINDOW = 50
+
+# Start a second request once the first has run longer than this latency
+# percentile of its endpoint; before enough samples exist use a fixed delay
+HEDGE_PERCENTILE = float(os.getenv("UPSCALER_HEDGE_PERCENTILE", "0.9"))
+HEDGE_MIN_SAMPLES = 5
+HEDGE_DELAY = float(os.getenv("UPSCALER_HEDGE_DELAY", "15"))
+
+# Circuit breaker: stop routing to an endpoint after this many failures in a
+# row, and let a single trial request through once the reset timeout passed
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("UPSCALER_CIRCUIT_FAILURES", "3"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("UPSCALER_CIRCUIT_RESET", "30"))
+
+UPSCALER_WORKERS = int(os.getenv("UPSCALER_WORKERS", "8"))
+# Seconds a space may go without sending anything. Bounds how long a hedged
+# request that lost while waiting for the response holds a router worker
+UPSCALE_READ_TIMEOUT = float(os.getenv("UPSCALE_READ_TIMEOUT", "60"))
+
+# Which backends to use: "remote" (the GFPGAN spaces), "local" (CPU
+# resampling in this process) or "auto" (both, the router picks)
+UPSCALER = os.getenv("UPSCALER", "remote")
+
+# Local upscaling: images above LOCAL_TILE_THRESHOLD pixels are split into
+# tiles that are resampled in parallel worker processes
+LOCAL_TILE_SIZE = int(os.getenv("LOCAL_UPSCALE_TILE_SIZE", "512"))
+LOCAL_TILE_THRESHOLD = int(os.getenv("LOCAL_UPSCALE_TILE_THRESHOLD", str(1024 * 1024)))
+LOCAL_TILE_MARGIN = 8  # Covers the Lanczos kernel and the sharpening radius
+LOCAL_PROCESSES = int(os.getenv("LOCAL_UPSCALE_PROCESSES", str(os.cpu_count() or 1)))
+LOCAL_SHARPEN = {"radius": 2, "percent": 60, "threshold": 2}  # UnsharpMask arguments
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class UpscaleCancelled(Exception):
+    pass
+
+class EndpointStats:
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latency = latency if self.latency is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+            self.error_rate = (1 - EWMA_ALPHA) * self.error_rate
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
+            self.state = CLOSED
+
+    def record_latency(self, latency):
+        # A lower bound from a request cancelled after losing a hedge
+        with self._lock:
+            self.latency = latency if self.latency is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+            self.latencies.append(latency)
+
+    def record_failure(self):
+        with self._lock:
+            self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def acquire(self):
+        # Whether a request may be sent now; moves an open circuit to half-open
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def release(self):
+        # A half-open trial that never ran does not decide the circuit's state
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def available(self):
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at >= CIRCUIT_RESET_TIMEOUT
+            return self.state == CLOSED
+
+    def score(self):
+        # Lower is better; endpoints without samples go first so they get measured
+        with self._lock:
+            if self.latency is None:
+                return 0.0
+            return self.latency * (1 + 4 * self.error_rate)
+
+    def percentile(self, p):
+        with self._lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "latency": self.latency,
+                "error_rate": self.error_rate,
+                "state": self.state,
+                "samples": len(self.latencies)
+            }
+
+class RemoteUpscaler:
+    """GFPGAN running on a Hugging Face space behind a gradio /api/predict.
+
+    A cancelled request stops between chunks of the response body. While
+    it is still waiting for the response headers it cannot be interrupted,
+    so it runs until the space answers or read_timeout passes.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, name, url, max_retries=http_client.MAX_RETRIES, read_timeout=UPSCALE_READ_TIMEOUT):
+        self.name = name
+        self.url = url
+        self.max_retries = max_retries
+        self.read_timeout = read_timeout
+
+    def upscale(self, record, version, scale_factor, cancel_event=None):
+        if cancel_event is not None and cancel_event.is_set():
+            raise UpscaleCancelled(self.name)  # Lost while queued for a worker
+        payload = {
+            "data": [
+                record.data_url(),
+                version,
+                scale_factor
+            ]
+        }
+        response = http_client.post(self.url, json=payload, stream=True, max_retries=self.max_retries,
+                                    timeout=(http_client.CONNECT_TIMEOUT, self.read_timeout))
+        try:
+            response.raise_for_status()
+            # Read in chunks so a cancelled (hedged) request stops downloading
+            chunks = []
+            for chunk in response.iter_content(self.chunk_size):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise UpscaleCancelled(self.name)
+                chunks.append(chunk)
+        finally:
+            response.close()
+
+        # The API returns a list of results, we're interested in the first item
+        result = json.loads(b"".join(chunks))
+        upscaled_image_data = result['data'][0].split(',')[1]
+        return ImageRecord(base64.b64decode(upscaled_image_data))
+
+def upscale_tile(mode, size, data, scale_factor):
+    # Runs in a worker process, so it takes and returns raw pixel bytes
+    from PIL import Image
+    tile = Image.frombytes(mode, size, data)
+    return resample(tile, scale_factor).tobytes()
+
+def resample(image, scale_factor):
+    from PIL import Image, ImageFilter
+    upscaled = image.resize((image.width * scale_factor, image.height * scale_factor), Image.Resampling.LANCZOS)
+    return upscaled.filter(ImageFilter.UnsharpMask(**LOCAL_SHARPEN))
+
+class LocalUpscaler:
+    """Lanczos resampling plus unsharp masking on the CPU.
+
+    Works offline and without uploading the image; it does not restore
+    faces like GFPGAN, so `version` is ignored.
+    """
+
+    name = "local"
+
+    def __init__(self, tile_size=LOCAL_TILE_SIZE, tile_threshold=LOCAL_TILE_THRESHOLD, processes=LOCAL_PROCESSES):
+        self.tile_size = tile_size
+        self.tile_threshold = tile_threshold
+        self.processes = processes
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Forking this process copies its threads' locks (HTTP pools, history
+                # writer, metrics server) in whatever state they are in, so start
+                # workers from a clean process instead
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context(method))
+            return self._pool
+
+    def upscale(self, record, version=None, scale_factor=2, cancel_event=None):
+        image = record.image
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        scale_factor = int(scale_factor)
+
+        if image.width * image.height <= self.tile_threshold or self.processes <= 1:
+            upscaled = resample(image, scale_factor)
+        else:
+            upscaled = self._upscale_tiled(image, scale_factor, cancel_event)
+        # Fast PNG compression: the output is large and encoded only once
+        return ImageRecord.from_image(upscaled, "PNG", compress_level=1)
+
+    def _upscale_tiled(self, image, scale_factor, cancel_event):
+        from PIL import Image
+        margin = LOCAL_TILE_MARGIN
+        upscaled = Image.new(image.mode, (image.width * scale_factor, image.height * scale_factor))
+        pool = self._get_pool()
+        futures = []
+        for top in range(0, image.height, self.tile_size):
+            for left in range(0, image.width, self.tile_size):
+                box = (left, top, min(left + self.tile_size, image.width), min(top + self.tile_size, image.height))
+                # Resample with a margin so tile edges get the same neighbours as in the full image
+                padded = (max(box[0] - margin, 0), max(box[1] - margin, 0),
+                          min(box[2] + margin, image.width), min(box[3] + margin, image.height))
+                tile = image.crop(padded)
+                future = pool.submit(upscale_tile, tile.mode, tile.size, tile.tobytes(), scale_factor)
+                futures.append((box, padded, tile.size, future))
+
+        for box, padded, tile_size, future in futures:
+            if cancel_event is not None and cancel_event.is_set():
+                for _, _, _, pending in futures:
+                    pending.cancel()
+                raise UpscaleCancelled(self.name)
+            size = (tile_size[0] * scale_factor, tile_size[1] * scale_factor)
+            tile = Image.frombytes(image.mode, size, future.result())
+            crop = ((box[0] - padded[0]) * scale_factor, (box[1] - padded[1]) * scale_factor,
+                    (box[2] - padded[0]) * scale_factor, (box[3] - padded[1]) * scale_factor)
+            upscaled.paste(tile.crop(crop), (box[0] * scale_factor, box[1] * scale_factor))
+        return upscaled
+
+# Registry of available backends by name
+UPSCALER_BACKENDS = {}
+
+def register_backend(backend):
+    UPSCALER_BACKENDS[backend.name] = backend
+    return backend
+
+class UpscaleRouter:
+    """Sends each upscale to the fastest healthy backend.
+
+    If it is slower than usual, a hedged request goes to the next backend
+    and whichever succeeds first wins; the other one is cancelled. Backends
+    that keep failing are skipped by their circuit breaker.
+    """
+
+    def __init__(self, backends, hedge_percentile=HEDGE_PERCENTILE, hedge_delay=HEDGE_DELAY, max_workers=UPSCALER_WORKERS):
+        self.backends = list(backends)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.stats = {backend.name: EndpointStats() for backend in self.backends}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upscale")
+
+    def ranked(self):
+        healthy = [backend for backend in self.backends if self.stats[backend.name].available()]
+        return sorted(healthy, key=lambda backend: self.stats[backend.name].score())
+
+    def _call(self, backend, record, version, scale_factor, cancel_event):
+        stats = self.stats[backend.name]
+        start = time.monotonic()
+        try:
+            result = backend.upscale(record, version, scale_factor, cancel_event)
+        except UpscaleCancelled:
+            stats.record_latency(time.monotonic() - start)
+            stats.release()
+            raise
+        except Exception as e:
+            if cancel_event.is_set():
+                # A hedge loser timing out is slow, not broken: keep it out of the circuit breaker
+                stats.record_latency(time.monotonic() - start)
+                stats.release()
+                raise UpscaleCancelled(backend.name) from e
+            stats.record_failure()
+            logger.error(f"Error upscaling image with {backend.name}: {str(e)}")
+            raise
+        stats.record_success(time.monotonic() - start)
+        return result
+
+    def _start(self, backend, record, version, scale_factor):
+        cancel_event = threading.Event()
+        future = self._executor.submit(self._call, backend, record, version, scale_factor, cancel_event)
+        return future, cancel_event
+
+    def upscale(self, record, version="v1.4", scale_factor=2):
+        candidates = deque(self.ranked())
+        pending = {}
+
+        def start_next():
+            while candidates:
+                backend = candidates.popleft()
+                if self.stats[backend.name].acquire():
+                    future, cancel_event = self._start(backend, record, version, scale_factor)
+                    pending[future] = (backend, cancel_event)
+                    return backend
+            return None
+
+        current = start_next()
+        if current is None:
+            logger.error("No healthy upscaler backend available")
+            return None
+        hedged = False
+
+        while pending:
+            timeout = None
+            if not hedged and candidates:
+                timeout = self.stats[current.name].percentile(self.hedge_percentile) or self.hedge_delay
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # The request is slower than usual: hedge on the next backend
+                hedged = True
+                backend = start_next()
+                if backend is not None:
+                    logger.warning(f"Upscale with {current.name} is slow, hedging with {backend.name}")
+                continue
+            for future in done:
+                pending.pop(future)
+                if future.exception() is None:
+                    for loser, (backend, cancel_event) in pending.items():
+                        cancel_event.set()
+                        if loser.cancel():
+                            self.stats[backend.name].release()
+                    return future.result()
+            # Every in-flight request failed: fail over to the next backend
+            if not pending:
+                current = start_next()
+        return None
+
+def build_router(urls=UPSCALE_API_URLS, mode=UPSCALER):
+    backends = []
+    if mode in ("remote", "auto"):
+        # No HTTP retries inside a backend: the router fails over to the next one
+        # instead, and each failure counts toward the backend's circuit breaker
+        backends += [register_backend(RemoteUpscaler(f"remote-{i}", url, max_retries=0)) for i, url in enumerate(urls)]
+    if mode in ("local", "auto"):
+        backends.append(register_backend(LocalUpscaler()))
+    if not backends:
+        raise ValueError(f"Unknown UPSCALER setting: {mode}")
+    return UpscaleRouter(backends)
+
+upscale_router = build_router()